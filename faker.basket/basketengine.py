@@ -0,0 +1,112 @@
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import polars as pl
+from create_index_tables import INDEX_TABLES
+
+# Ticks between exact recomputations of every level, bounds the rounding the deltas accumulate
+REBASE_EVERY = 10_000
+
+
+def load_basket_definitions(client) -> pl.DataFrame:
+    """name, sym, weight, model and ticker of each basket's latest asofDate in ref_basketdef"""
+    query = f"""
+    SELECT name, sym, weight, model, ticker
+    FROM {INDEX_TABLES.REF_BASKETDEF.value} FINAL
+    WHERE (name, asofDate) IN (
+        SELECT name, max(asofDate) FROM {INDEX_TABLES.REF_BASKETDEF.value} GROUP BY name
+    )
+    """
+    definitions = pl.from_arrow(client.query_arrow(query))
+    return definitions.with_columns(pl.col('name', 'sym', 'model', 'ticker').cast(pl.Utf8))
+
+
+class BasketEngine:
+    """Basket levels kept current from constituent ticks through an inverted index.
+
+    Each constituent sym maps to the (basket, weight) pairs that hold it,
+    stored CSR-style: the pairs sorted by sym in flat arrays and an offsets
+    array per sym. A tick adds weight x price change to every basket that
+    holds the sym, so its cost is the sym's fan-out, not the baskets' size.
+    A level is the weighted sum of its constituents' last prices, with the
+    weights as stored in ref_basketdef; it is complete once every
+    constituent has been priced.
+    """
+
+    def __init__(self, definitions: pl.DataFrame):
+        self.baskets: List[str] = sorted(set(definitions['name'].to_list()))
+        self.basket_index: Dict[str, int] = {name: i for i, name in enumerate(self.baskets)}
+        self.syms: List[str] = sorted(set(definitions['sym'].to_list()))
+        self.sym_index: Dict[str, int] = {sym: i for i, sym in enumerate(self.syms)}
+
+        basket = np.fromiter((self.basket_index[n] for n in definitions['name'].to_list()), dtype=np.int64,
+                             count=len(definitions))
+        sym = np.fromiter((self.sym_index[s] for s in definitions['sym'].to_list()), dtype=np.int64,
+                          count=len(definitions))
+        order = np.argsort(sym, kind='stable')
+        self._sym_of = sym[order]
+        self._basket_of = basket[order]
+        self._weight_of = definitions['weight'].cast(pl.Float64).to_numpy()[order]
+        self._offsets = np.concatenate([[0], np.cumsum(np.bincount(sym, minlength=len(self.syms)))])
+
+        self.price = np.full(len(self.syms), np.nan)
+        self.level = np.zeros(len(self.baskets))
+        # constituents still without a price, a basket is complete at zero
+        self.missing = np.bincount(basket, minlength=len(self.baskets))
+        # level when the basket first became complete, published as yest
+        self.open = np.full(len(self.baskets), np.nan)
+        self.ticks = 0
+
+    def __len__(self) -> int:
+        return len(self.baskets)
+
+    @property
+    def complete(self) -> np.ndarray:
+        return self.missing == 0
+
+    def on_prices(self, syms: Sequence[str], prices: Sequence[float]) -> np.ndarray:
+        """Apply one tick of constituent prices, returns the indices of the baskets whose level changed"""
+        idx = np.fromiter((self.sym_index.get(s, -1) for s in syms), dtype=np.int64, count=len(syms))
+        prices = np.asarray(prices, dtype=np.float64)
+        known = idx >= 0
+        # a sym ticking twice in one batch counts once, at its latest price
+        idx, last = np.unique(idx[known][::-1], return_index=True)
+        prices = prices[known][::-1][last]
+
+        old = self.price[idx]
+        first = np.isnan(old)
+        delta = prices - np.where(first, 0.0, old)
+        moved = (delta != 0) | first
+        idx, delta, first = idx[moved], delta[moved], first[moved]
+        self.price[idx] = prices[moved]
+
+        starts = self._offsets[idx]
+        fanout = self._offsets[idx + 1] - starts
+        # positions of every (basket, weight) pair of the moved syms
+        entries = np.repeat(starts - np.cumsum(fanout) + fanout, fanout) + np.arange(fanout.sum())
+        baskets = self._basket_of[entries]
+        np.add.at(self.level, baskets, self._weight_of[entries] * np.repeat(delta, fanout))
+        if first.any():
+            np.subtract.at(self.missing, baskets[np.repeat(first, fanout)], 1)
+            opened = self.complete & np.isnan(self.open)
+            self.open[opened] = self.level[opened]
+
+        self.ticks += 1
+        if self.ticks % REBASE_EVERY == 0:
+            self.rebase()
+        return np.unique(baskets)
+
+    def rebase(self) -> None:
+        """Recompute every level from the last prices"""
+        contribution = self._weight_of * np.nan_to_num(self.price[self._sym_of])
+        self.level = np.bincount(self._basket_of, weights=contribution, minlength=len(self.baskets))
+
+    def quotes(self, idx: np.ndarray) -> Dict[str, np.ndarray]:
+        """last/bid/ask/spread/yest arrays for baskets idx, as pricecodec.pack_quotes takes them"""
+        level = self.level[idx]
+        return {'last': level, 'bid': level, 'ask': level, 'spread': np.zeros(len(idx)), 'yest': self.open[idx]}
+
+    def levels(self, names: Optional[Sequence[str]] = None) -> Dict[str, float]:
+        """Current level of every complete basket, or of names"""
+        idx = np.flatnonzero(self.complete) if names is None else [self.basket_index[n] for n in names]
+        return {self.baskets[i]: float(self.level[i]) for i in idx}
@@ -1,20 +1,67 @@
 import asyncio
+import os
+import sys
 import threading
+import time
+from pathlib import Path
 from typing import Optional
-import redis
+import redis.asyncio as aredis
 import random
 import json
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import polars as pl
+
+# Share the market simulator with the financing pricing service
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'faker.financing'))
+from backends import make_async_client
+from marketsim import MarketSimulator, SimulatorConfig, correlated_simulator, load_instrument_universe
+from metrics import REGISTRY
+from pricecodec import decode_message, encode_message, pack_quotes
+from basketengine import BasketEngine, load_basket_definitions
+from create_index_tables import Store
+from universe import seed_prices
+
+# 'packed' binary messages of many instruments (pricecodec.encode_message) or one 'json' message per instrument
+ENCODINGS = ('packed', 'json')
+
+PUBLISHED = REGISTRY.counter('basket_prices_published_total', 'Price updates published')
+PROCESSED = REGISTRY.counter('basket_prices_processed_total', 'Price updates processed')
+ERRORS = REGISTRY.counter('basket_errors_total', 'Errors in the generator and processor loops')
+PUBLISH_SECONDS = REGISTRY.histogram('basket_publish_seconds', 'Time to publish one generation of prices')
+PROCESS_SECONDS = REGISTRY.histogram('basket_process_seconds', 'Time to process one batch of price updates')
+PROCESS_BATCH = REGISTRY.histogram('basket_process_batch_size', 'Price updates processed per processor wake-up', unit=1)
+BASKETS_UPDATED = REGISTRY.counter('basket_levels_published_total', 'Basket levels published')
+LAG_SECONDS = REGISTRY.histogram('basket_publish_to_process_seconds', 'Price timestamp to processing start')
 
 class PriceGeneratorService:
-    def __init__(self, redis_client: redis.Redis, instruments: list[str], max_workers: int = 4):
+    """Publishes a price for every instrument each interval on price_updates.
+
+    With encoding='packed' a tick goes out as a few binary messages of up to
+    chunk_size instruments (pricecodec.encode_message) in one pipeline;
+    'json' publishes one JSON document per instrument, also pipelined.
+    """
+
+    def __init__(self, redis_client: aredis.Redis, instruments: list[str], max_workers: int = 4,
+                 simulator: Optional[MarketSimulator] = None, encoding: str = 'packed',
+                 chunk_size: int = 10_000, interval: float = 1.0, channel: str = 'price_updates'):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
         self._executor = ThreadPoolExecutor(max_workers=max_workers)
         self._running = False
         self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._thread: Optional[threading.Thread] = None
+        # asyncio client, only used from the generator's own event loop
         self._redis = redis_client
         self._instruments = instruments
+        # Optional simulator, e.g. with a FactorModel for correlated prices
+        self._simulator = simulator
+        self._simulator_idx = simulator.indices(instruments) if simulator is not None else None
+        self._encoding = encoding
+        self._chunk_size = chunk_size
+        self._interval = interval
+        self._channel = channel
 
     async def _generate_price(self, instrument: str):
         price = random.uniform(90, 110)
@@ -25,16 +72,56 @@ class PriceGeneratorService:
             'timestamp': timestamp
         }
 
+    def _simulated_prices(self) -> list[dict]:
+        self._simulator.step(self._simulator_idx)
+        timestamp = datetime.now().isoformat()
+        return [
+            {'instrument': instrument, 'price': price, 'timestamp': timestamp}
+            for instrument, price in zip(self._instruments, self._simulator.last[self._simulator_idx].tolist())
+        ]
+
+    def _tick_records(self) -> np.ndarray:
+        """Packed records of this tick's prices, in instrument order"""
+        if self._simulator is not None:
+            self._simulator.step(self._simulator_idx)
+            quotes = self._simulator.quotes(self._simulator_idx)
+        else:
+            last = np.round(np.random.uniform(90, 110, len(self._instruments)), 2)
+            quotes = {'last': last, 'bid': last, 'ask': last, 'spread': 0.0, 'yest': last}
+        return pack_quotes(quotes, time.time_ns())
+
+    async def _publish_tick(self) -> int:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            if self._encoding == 'packed':
+                records = self._tick_records()
+                for i in range(0, len(records), self._chunk_size):
+                    chunk = slice(i, i + self._chunk_size)
+                    await pipe.publish(self._channel, encode_message(self._instruments[chunk], records[chunk]))
+            else:
+                if self._simulator is not None:
+                    prices = self._simulated_prices()
+                else:
+                    prices = [await self._generate_price(instrument) for instrument in self._instruments]
+                for price_data in prices:
+                    await pipe.publish(self._channel, json.dumps(price_data))
+            await pipe.execute()
+        return len(self._instruments)
+
     async def _process_queue(self):
+        deadline = time.monotonic()
         while self._running:
             try:
-                for instrument in self._instruments:
-                    price_data = await self._generate_price(instrument)
-                    # Publish to Redis
-                    self._redis.publish('price_updates', json.dumps(price_data))
-                await asyncio.sleep(1)  # Generate prices every second
+                with PUBLISH_SECONDS.time():
+                    published = await self._publish_tick()
+                PUBLISHED.inc(published)
             except Exception as e:
+                ERRORS.inc()
                 print(f"Error generating prices: {e}")
+            # Fixed-rate ticks, a slow tick delays the next one instead of queueing them up
+            deadline = max(deadline + self._interval, time.monotonic())
+            await asyncio.sleep(deadline - time.monotonic())
+        # The client's connections belong to this event loop
+        await self._redis.aclose()
 
     def _run_event_loop(self):
         self._loop = asyncio.new_event_loop()
@@ -77,32 +164,106 @@ class PriceGeneratorService:
         )
 
 class PriceProcessorService:
-    def __init__(self, redis_client: redis.Redis, max_workers: int = 4):
+    """Consumes price_updates on an asyncio pub/sub connection.
+
+    Each wake-up blocks until a message arrives, then drains whatever else
+    is already buffered (up to batch_size) and processes it as one batch,
+    so throughput follows the publish rate instead of a polling interval.
+    encoding must match the generator's. With a BasketEngine each batch
+    updates the baskets holding the priced syms, and their new levels are
+    published on levels_channel as one packed message.
+    """
+
+    def __init__(self, redis_client: aredis.Redis, max_workers: int = 4, batch_size: int = 1000,
+                 channel: str = 'price_updates', encoding: str = 'packed',
+                 engine: Optional[BasketEngine] = None, levels_channel: str = 'basket_levels'):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding {encoding}, expected one of {ENCODINGS}")
         self._executor = ThreadPoolExecutor(max_workers=max_workers)
         self._running = False
         self._loop: Optional[asyncio.AbstractEventLoop] = None
         self._thread: Optional[threading.Thread] = None
+        # asyncio client, only used from the processor's own event loop
         self._redis = redis_client
-        self._pubsub = redis_client.pubsub()
+        self._batch_size = batch_size
+        self._channel = channel
+        self._encoding = encoding
+        # Basket levels updated from the prices and published on levels_channel, the mock markup without one
+        self._engine = engine
+        self._levels_channel = levels_channel
+
+    async def _process_records(self, last: np.ndarray) -> np.ndarray:
+        # Mock calculation when there is no basket engine
+        return last * 1.1  # Simple 10% markup calculation
+
+    async def _update_baskets(self, ids: list[str], last: np.ndarray) -> int:
+        changed = self._engine.on_prices(ids, last)
+        changed = changed[self._engine.complete[changed]]
+        if len(changed):
+            records = pack_quotes(self._engine.quotes(changed), time.time_ns())
+            await self._redis.publish(self._levels_channel,
+                                      encode_message([self._engine.baskets[i] for i in changed], records))
+        BASKETS_UPDATED.inc(len(changed))
+        return len(changed)
+
+    async def _drain(self, pubsub) -> list[dict]:
+        """Wait up to a second for one message, then take what is already buffered without waiting"""
+        messages = []
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        while message is not None:
+            messages.append(message)
+            if len(messages) >= self._batch_size:
+                break
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.0)
+        return messages
+
+    def _decode_json(self, messages: list[dict]) -> tuple[list[str], np.ndarray]:
+        now = datetime.now()
+        prices = [json.loads(message['data']) for message in messages]
+        for price_data in prices:
+            LAG_SECONDS.record((now - datetime.fromisoformat(price_data['timestamp'])).total_seconds())
+        return [p['instrument'] for p in prices], np.array([p['price'] for p in prices], dtype=np.float64)
 
-    async def _process_price(self, price_data: dict):
-        # Mock calculation - replace with your actual logic
-        price = price_data['price']
-        return price * 1.1  # Simple 10% markup calculation
+    def _decode_packed(self, messages: list[dict]) -> tuple[list[str], np.ndarray]:
+        now = time.time_ns()
+        ids, last = [], []
+        for message in messages:
+            message_ids, records = decode_message(message['data'])
+            if message_ids:
+                # a message is one tick, so one lag sample per message
+                LAG_SECONDS.record((now - int(records['ts'][0])) / 1e9)
+                ids.extend(message_ids)
+                last.append(records['last'])
+        return ids, np.concatenate(last) if last else np.empty(0)
 
     async def _process_queue(self):
-        self._pubsub.subscribe('price_updates')
-        
-        while self._running:
-            try:
-                message = self._pubsub.get_message()
-                if message and message['type'] == 'message':
-                    price_data = json.loads(message['data'])
-                    result = await self._process_price(price_data)
-                    print(f"Processed {price_data['instrument']}: {result}")
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                print(f"Error processing prices: {e}")
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self._channel)
+        decode = self._decode_packed if self._encoding == 'packed' else self._decode_json
+        try:
+            while self._running:
+                try:
+                    messages = await self._drain(pubsub)
+                    if not messages:
+                        continue
+                    ids, last = decode(messages)
+                    if not ids:
+                        continue
+                    with PROCESS_SECONDS.time():
+                        if self._engine is not None:
+                            summary = f"{await self._update_baskets(ids, last)} baskets updated"
+                        else:
+                            summary = f"last {ids[-1]}: {(await self._process_records(last))[-1]}"
+                    PROCESS_BATCH.record(len(ids))
+                    PROCESSED.inc(len(ids))
+                    print(f"Processed {len(ids)} prices, {summary}")
+                except Exception as e:
+                    ERRORS.inc()
+                    print(f"Error processing prices: {e}")
+        finally:
+            await pubsub.unsubscribe(self._channel)
+            await pubsub.aclose()
+            await self._redis.aclose()
 
     def _run_event_loop(self):
         self._loop = asyncio.new_event_loop()
@@ -145,13 +306,29 @@ class PriceProcessorService:
         )
 
 async def main():
-    # Setup Redis client
-    redis_client = redis.Redis(host='localhost', port=6379, db=0)
+    # PRICE_BACKEND=memory runs both services on an in-process keyspace, PRICE_ENCODING=json for readable messages
+    backend = os.getenv('PRICE_BACKEND', 'redis')
+    encoding = os.getenv('PRICE_ENCODING', 'packed')
+    # One asyncio client per service, each is only used from its own event loop
+    generator_client = make_async_client(backend, host='localhost', port=6379)
+    processor_client = make_async_client(backend, host='localhost', port=6379)
     
-    # Create services
-    instruments = ['AAPL', 'GOOGL', 'MSFT', 'AMZN']
-    generator = PriceGeneratorService(redis_client, instruments)
-    processor = PriceProcessorService(redis_client)
+    # Create services, pricing every constituent of the baskets in ref_basketdef
+    store = Store()
+    engine = BasketEngine(load_basket_definitions(store.client))
+    # Constituents are ref_instruments ids, each moves with its own sector, region and currency factors
+    universe = pl.DataFrame({'id': engine.syms}).join(load_instrument_universe(store.client), on='id', how='left')
+    store.close()
+    instruments = engine.syms
+    unknown = universe['sector'].null_count()
+    print(f"Loaded {len(engine)} baskets over {len(instruments)} constituents, {unknown} not in ref_instruments")
+    universe = universe.with_columns(pl.col('sector', 'region', 'currency').fill_null('UNKNOWN'),
+                                     price=seed_prices(universe))
+    simulator = correlated_simulator(universe, SimulatorConfig(volatility=0.3))
+    generator = PriceGeneratorService(generator_client, instruments, simulator=simulator, encoding=encoding)
+    processor = PriceProcessorService(processor_client, encoding=encoding, engine=engine)
+    # Prometheus text on :9109/metrics, METRICS_PORT / METRICS_FILE override
+    REGISTRY.export(default_port=9109)
     
     # Start services
     generator.start()
@@ -166,8 +343,6 @@ async def main():
         # Stop services
         generator.stop()
         processor.stop() 
-        # Close Redis connection
-        redis_client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,589 @@
+import asyncio
+import fnmatch
+import itertools
+import queue
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+import redis.asyncio as aredis # type: ignore
+from redis.exceptions import ResponseError
+
+BACKENDS = ('redis', 'memory')
+
+
+def _bytes(value) -> bytes:
+    """Encode a value the way redis-py does on the wire"""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return repr(float(value)).encode()
+    if hasattr(value, 'item'):  # numpy scalars
+        return _bytes(value.item())
+    return str(value).encode()
+
+
+def _key(key) -> str:
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+def _stream_id(entry_id) -> Tuple[int, int]:
+    ms, _, seq = _key(entry_id).partition('-')
+    return int(ms), int(seq or 0)
+
+
+def _format_id(entry_id: Tuple[int, int]) -> bytes:
+    return f'{entry_id[0]}-{entry_id[1]}'.encode()
+
+
+class _Group:
+    def __init__(self, last_delivered: Tuple[int, int]):
+        self.last_delivered = last_delivered
+        # entry id -> [consumer, delivered at (ms), delivery count]
+        self.pending: Dict[Tuple[int, int], list] = {}
+
+
+class _Stream:
+    def __init__(self):
+        self.entries: Dict[Tuple[int, int], Dict[bytes, bytes]] = {}
+        self.last_id = (0, 0)
+        self.groups: Dict[str, _Group] = {}
+
+
+class MemoryStore:
+    """Keyspace shared by every in-memory client created for the same name (host:port)"""
+
+    _stores: Dict[str, 'MemoryStore'] = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data: Dict[str, Any] = {}
+        self.expires: Dict[str, float] = {}
+        self.channels: Dict[bytes, List['MemoryPubSub']] = {}
+        # commands run through pipelines and the asyncio client, reported as total_commands_processed
+        self.commands = 0
+
+    @classmethod
+    def named(cls, name: str) -> 'MemoryStore':
+        with cls._stores_lock:
+            return cls._stores.setdefault(name, cls())
+
+
+class MemoryPipeline:
+    """Queues commands and runs them in order under the store lock on execute"""
+
+    def __init__(self, client: 'MemoryRedis'):
+        self._client = client
+        self._commands: List[Tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, name: str):
+        getattr(self._client, name)  # unknown commands fail when queued, like redis-py
+
+        def queue_command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue_command
+
+    def execute(self, raise_on_error: bool = True) -> list:
+        commands, self._commands = self._commands, []
+        results = []
+        with self._client.store.lock:
+            self._client.store.commands += len(commands)
+            for name, args, kwargs in commands:
+                try:
+                    results.append(getattr(self._client, name)(*args, **kwargs))
+                except ResponseError as e:
+                    if raise_on_error:
+                        raise
+                    results.append(e)
+        return results
+
+    def reset(self) -> None:
+        self._commands = []
+
+    def __enter__(self) -> 'MemoryPipeline':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.reset()
+
+
+class MemoryPubSub:
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self.channels: set = set()
+        self._messages: queue.Queue = queue.Queue()
+
+    def subscribe(self, *channels) -> None:
+        with self.store.lock:
+            for channel in map(_bytes, channels):
+                if channel not in self.channels:
+                    self.channels.add(channel)
+                    self.store.channels.setdefault(channel, []).append(self)
+                self._messages.put({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                                    'data': len(self.channels)})
+
+    def unsubscribe(self, *channels) -> None:
+        with self.store.lock:
+            for channel in list(map(_bytes, channels)) or list(self.channels):
+                if channel in self.channels:
+                    self.channels.discard(channel)
+                    self.store.channels[channel].remove(self)
+                self._messages.put({'type': 'unsubscribe', 'pattern': None, 'channel': channel,
+                                    'data': len(self.channels)})
+
+    def _deliver(self, channel: bytes, data: bytes) -> None:
+        self._messages.put({'type': 'message', 'pattern': None, 'channel': channel, 'data': data})
+
+    def get_message(self, ignore_subscribe_messages: bool = False, timeout: float = 0.0) -> Optional[dict]:
+        deadline = time.monotonic() + (timeout or 0.0)
+        while True:
+            try:
+                message = self._messages.get(timeout=max(deadline - time.monotonic(), 0)) if timeout \
+                    else self._messages.get_nowait()
+            except queue.Empty:
+                return None
+            if not (ignore_subscribe_messages and message['type'] != 'message'):
+                return message
+
+    def listen(self):
+        while self.channels:
+            yield self._messages.get()
+
+    def close(self) -> None:
+        self.unsubscribe()
+
+    reset = close
+
+
+class MemoryRedis:
+    """Pure in-process stand-in for the part of redis.Redis the pricing and basket services use.
+
+    Values come back as bytes like a client without decode_responses.
+    Streams support consumer groups, pending entries, acknowledgements and
+    XAUTOCLAIM; MAXLEN trimming is always exact.
+    """
+
+    def __init__(self, store: Optional[MemoryStore] = None):
+        self.store = store or MemoryStore()
+        # SCAN/SSCAN walk a snapshot taken when the cursor is 0, every page hands out a fresh cursor
+        # naming that scan's snapshot and offset, so concurrent scans never share state
+        self._scans: Dict[int, Tuple[list, int]] = {}
+        self._cursors = itertools.count(1)
+
+    def _page(self, snapshot, cursor: int, count: Optional[int]):
+        if cursor == 0:
+            items, offset = snapshot(), 0
+        elif cursor in self._scans:
+            items, offset = self._scans.pop(cursor)
+        else:
+            return 0, []
+        end = offset + (count or 10)
+        if end >= len(items):
+            return 0, items[offset:]
+        cursor = next(self._cursors)
+        self._scans[cursor] = (items, end)
+        return cursor, items[offset:end]
+
+    # keys
+    def _get(self, key, kind=None, create=None):
+        key = _key(key)
+        expires = self.store.expires.get(key)
+        if expires is not None and expires <= time.time():
+            self.store.data.pop(key, None)
+            self.store.expires.pop(key, None)
+        value = self.store.data.get(key)
+        if value is None and create is not None:
+            value = self.store.data[key] = create()
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise ResponseError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def exists(self, *keys) -> int:
+        with self.store.lock:
+            return sum(self._get(k) is not None for k in keys)
+
+    def delete(self, *keys) -> int:
+        with self.store.lock:
+            removed = 0
+            for key in map(_key, keys):
+                removed += self._get(key) is not None
+                self.store.data.pop(key, None)
+                self.store.expires.pop(key, None)
+            return removed
+
+    unlink = delete
+
+    def flushdb(self, asynchronous: bool = False) -> bool:
+        with self.store.lock:
+            self.store.data.clear()
+            self.store.expires.clear()
+        return True
+
+    def dbsize(self) -> int:
+        with self.store.lock:
+            return sum(self._get(k) is not None for k in list(self.store.data))
+
+    def scan(self, cursor: int = 0, match: Optional[str] = None, count: Optional[int] = None, _type=None):
+        with self.store.lock:
+            cursor, keys = self._page(lambda: list(self.store.data), cursor, count)
+        return cursor, [k.encode() for k in keys if match is None or fnmatch.fnmatchcase(k, match)]
+
+    def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None, _type=None):
+        cursor = 0
+        while True:
+            cursor, keys = self.scan(cursor, match, count)
+            yield from keys
+            if cursor == 0:
+                return
+
+    # strings
+    def get(self, key) -> Optional[bytes]:
+        with self.store.lock:
+            return self._get(key, bytes)
+
+    def set(self, key, value, ex: Optional[float] = None, **kwargs) -> bool:
+        with self.store.lock:
+            key = _key(key)
+            self.store.data[key] = _bytes(value)
+            self.store.expires.pop(key, None)
+            if ex is not None:
+                self.store.expires[key] = time.time() + ex
+            return True
+
+    def mget(self, keys, *args) -> List[Optional[bytes]]:
+        keys = list(keys) if not isinstance(keys, (str, bytes)) else [keys]
+        with self.store.lock:
+            return [self._get(k, bytes) for k in keys + list(args)]
+
+    def mset(self, mapping: Dict) -> bool:
+        with self.store.lock:
+            for key, value in mapping.items():
+                self.set(key, value)
+            return True
+
+    def incr(self, key, amount: int = 1) -> int:
+        with self.store.lock:
+            value = int(self._get(key, bytes) or 0) + amount
+            self.store.data[_key(key)] = _bytes(value)
+            return value
+
+    # hashes
+    def hset(self, key, field=None, value=None, mapping: Optional[Dict] = None) -> int:
+        with self.store.lock:
+            fields = self._get(key, dict, create=dict)
+            items = dict(mapping or {})
+            if field is not None:
+                items[field] = value
+            added = 0
+            for f, v in items.items():
+                f = _bytes(f)
+                added += f not in fields
+                fields[f] = _bytes(v)
+            return added
+
+    def hget(self, key, field) -> Optional[bytes]:
+        with self.store.lock:
+            return (self._get(key, dict) or {}).get(_bytes(field))
+
+    def hmget(self, key, keys, *args) -> List[Optional[bytes]]:
+        keys = list(keys) if not isinstance(keys, (str, bytes)) else [keys]
+        with self.store.lock:
+            fields = self._get(key, dict) or {}
+            return [fields.get(_bytes(f)) for f in keys + list(args)]
+
+    def hgetall(self, key) -> Dict[bytes, bytes]:
+        with self.store.lock:
+            return dict(self._get(key, dict) or {})
+
+    # sets
+    def sadd(self, key, *values) -> int:
+        with self.store.lock:
+            members = self._get(key, set, create=set)
+            before = len(members)
+            members.update(map(_bytes, values))
+            return len(members) - before
+
+    def srem(self, key, *values) -> int:
+        with self.store.lock:
+            members = self._get(key, set) or set()
+            before = len(members)
+            members.difference_update(map(_bytes, values))
+            return before - len(members)
+
+    def smembers(self, key) -> set:
+        with self.store.lock:
+            return set(self._get(key, set) or ())
+
+    def scard(self, key) -> int:
+        with self.store.lock:
+            return len(self._get(key, set) or ())
+
+    def sscan(self, key, cursor: int = 0, match: Optional[str] = None, count: Optional[int] = None):
+        with self.store.lock:
+            cursor, members = self._page(lambda: list(self._get(key, set) or ()), cursor, count)
+        return cursor, [m for m in members if match is None or fnmatch.fnmatchcase(m.decode(), match)]
+
+    # pub/sub
+    def publish(self, channel, message) -> int:
+        channel = _bytes(channel)
+        with self.store.lock:
+            subscribers = list(self.store.channels.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub._deliver(channel, _bytes(message))
+        return len(subscribers)
+
+    def pubsub(self, **kwargs) -> MemoryPubSub:
+        return MemoryPubSub(self.store)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+    # streams
+    def xadd(self, name, fields: Dict, id='*', maxlen: Optional[int] = None, approximate: bool = True, **kwargs) -> bytes:
+        with self.store.lock:
+            stream = self._get(name, _Stream, create=_Stream)
+            if id == '*':
+                ms = int(time.time() * 1000)
+                entry_id = (ms, 0) if ms > stream.last_id[0] else (stream.last_id[0], stream.last_id[1] + 1)
+            else:
+                entry_id = _stream_id(id)
+                if entry_id <= stream.last_id:
+                    raise ResponseError('ERR The ID specified in XADD is equal or smaller than the target stream top item')
+            stream.entries[entry_id] = {_bytes(k): _bytes(v) for k, v in fields.items()}
+            stream.last_id = entry_id
+            if maxlen is not None:
+                for old in list(stream.entries)[:max(len(stream.entries) - maxlen, 0)]:
+                    del stream.entries[old]
+            return _format_id(entry_id)
+
+    def xlen(self, name) -> int:
+        with self.store.lock:
+            return len((self._get(name, _Stream) or _Stream()).entries)
+
+    def xgroup_create(self, name, groupname, id='$', mkstream: bool = False, **kwargs) -> bool:
+        with self.store.lock:
+            stream = self._get(name, _Stream, create=_Stream if mkstream else None)
+            if stream is None:
+                raise ResponseError('ERR The XGROUP subcommand requires the key to exist')
+            if _key(groupname) in stream.groups:
+                raise ResponseError('BUSYGROUP Consumer Group name already exists')
+            stream.groups[_key(groupname)] = _Group(stream.last_id if id == '$' else _stream_id(id))
+            return True
+
+    def _group(self, name, groupname) -> Tuple[_Stream, _Group]:
+        stream = self._get(name, _Stream)
+        group = stream.groups.get(_key(groupname)) if stream else None
+        if group is None:
+            raise ResponseError(f"NOGROUP No such key '{_key(name)}' or consumer group '{_key(groupname)}'")
+        return stream, group
+
+    def xreadgroup(self, groupname, consumername, streams: Dict, count: Optional[int] = None,
+                   block: Optional[int] = None, noack: bool = False) -> list:
+        """Non-blocking read, block is handled by the asyncio client"""
+        consumer = _key(consumername)
+        response = []
+        with self.store.lock:
+            now = int(time.time() * 1000)
+            for name, last_id in streams.items():
+                stream, group = self._group(name, groupname)
+                entries = []
+                if _key(last_id) == '>':
+                    for entry_id in [i for i in stream.entries if i > group.last_delivered][:count]:
+                        entries.append((_format_id(entry_id), stream.entries[entry_id]))
+                        group.last_delivered = entry_id
+                        if not noack:
+                            group.pending[entry_id] = [consumer, now, 1]
+                    if entries:
+                        response.append([_bytes(name), entries])
+                else:
+                    start = _stream_id(last_id)
+                    for entry_id, state in sorted(group.pending.items()):
+                        if state[0] == consumer and entry_id > start:
+                            state[1], state[2] = now, state[2] + 1
+                            entries.append((_format_id(entry_id), stream.entries.get(entry_id)))
+                            if count and len(entries) >= count:
+                                break
+                    response.append([_bytes(name), entries])
+        return response
+
+    def xack(self, name, groupname, *ids) -> int:
+        with self.store.lock:
+            _, group = self._group(name, groupname)
+            return sum(group.pending.pop(_stream_id(i), None) is not None for i in ids)
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time: int, start_id='0-0',
+                   count: Optional[int] = None, justid: bool = False) -> list:
+        with self.store.lock:
+            stream, group = self._group(name, groupname)
+            now = int(time.time() * 1000)
+            start = _stream_id(start_id)
+            claimed, deleted = [], []
+            candidates = [i for i in sorted(group.pending) if i >= start]
+            for entry_id in candidates:
+                if count and len(claimed) >= count:
+                    return [_format_id(entry_id), claimed, deleted]
+                state = group.pending[entry_id]
+                if now - state[1] < min_idle_time:
+                    continue
+                if entry_id not in stream.entries:
+                    del group.pending[entry_id]
+                    deleted.append(_format_id(entry_id))
+                    continue
+                group.pending[entry_id] = [_key(consumername), now, state[2] + 1]
+                claimed.append(_format_id(entry_id) if justid else (_format_id(entry_id), stream.entries[entry_id]))
+            return [b'0-0', claimed, deleted]
+
+    # server
+    def ping(self) -> bool:
+        return True
+
+    def info(self, section: Optional[str] = None) -> Dict[str, Any]:
+        with self.store.lock:
+            used = sum(self._size(k, v) for k, v in self.store.data.items())
+        return {'used_memory': used, 'total_commands_processed': self.store.commands, 'redis_version': 'memory'}
+
+    def memory_usage(self, key, samples=None) -> Optional[int]:
+        with self.store.lock:
+            value = self._get(key)
+            return None if value is None else self._size(_key(key), value)
+
+    @staticmethod
+    def _size(key: str, value) -> int:
+        if isinstance(value, dict):
+            inner = sum(sys.getsizeof(f) + sys.getsizeof(v) for f, v in value.items())
+        elif isinstance(value, set):
+            inner = sum(sys.getsizeof(m) for m in value)
+        elif isinstance(value, _Stream):
+            inner = sum(sys.getsizeof(v) for fields in value.entries.values() for v in fields.values())
+        else:
+            inner = 0
+        return sys.getsizeof(key) + sys.getsizeof(value) + inner
+
+    def close(self) -> None:
+        pass
+
+
+class AsyncMemoryPipeline:
+    def __init__(self, client: MemoryRedis):
+        self._pipeline = MemoryPipeline(client)
+
+    def __getattr__(self, name: str):
+        queue_command = getattr(self._pipeline, name)
+
+        def queue_async(*args, **kwargs):
+            queue_command(*args, **kwargs)
+            return self
+        return queue_async
+
+    def __await__(self):
+        # redis.asyncio pipelines are awaited after queueing a command
+        return self._ready().__await__()
+
+    async def _ready(self) -> 'AsyncMemoryPipeline':
+        return self
+
+    async def execute(self, raise_on_error: bool = True) -> list:
+        return self._pipeline.execute(raise_on_error)
+
+    async def __aenter__(self) -> 'AsyncMemoryPipeline':
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._pipeline.reset()
+
+
+class AsyncMemoryPubSub:
+    def __init__(self, pubsub: MemoryPubSub):
+        self._pubsub = pubsub
+
+    async def subscribe(self, *channels) -> None:
+        self._pubsub.subscribe(*channels)
+
+    async def unsubscribe(self, *channels) -> None:
+        self._pubsub.unsubscribe(*channels)
+
+    async def get_message(self, ignore_subscribe_messages: bool = False, timeout: Optional[float] = 0.0) -> Optional[dict]:
+        deadline = time.monotonic() + (timeout or 0.0)
+        while True:
+            message = self._pubsub.get_message(ignore_subscribe_messages)
+            if message is not None or time.monotonic() >= deadline:
+                return message
+            await asyncio.sleep(0.001)
+
+    async def listen(self):
+        while self._pubsub.channels:
+            message = await self.get_message(timeout=1.0)
+            if message is not None:
+                yield message
+
+    async def aclose(self) -> None:
+        self._pubsub.close()
+
+    close = reset = aclose
+
+
+class AsyncMemoryRedis:
+    """redis.asyncio flavour of MemoryRedis: same commands, awaited"""
+
+    def __init__(self, store: Optional[MemoryStore] = None):
+        self._client = MemoryRedis(store)
+        self.store = self._client.store
+
+    def __getattr__(self, name: str):
+        command = getattr(self._client, name)
+
+        async def run(*args, **kwargs):
+            self.store.commands += 1
+            return command(*args, **kwargs)
+        return run
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> AsyncMemoryPipeline:
+        return AsyncMemoryPipeline(self._client)
+
+    def pubsub(self, **kwargs) -> AsyncMemoryPubSub:
+        return AsyncMemoryPubSub(self._client.pubsub())
+
+    async def scan_iter(self, match: Optional[str] = None, count: Optional[int] = None, _type=None):
+        for key in self._client.scan_iter(match, count):
+            yield key
+
+    async def xreadgroup(self, groupname, consumername, streams: Dict, count: Optional[int] = None,
+                         block: Optional[int] = None, noack: bool = False) -> list:
+        deadline = time.monotonic() + (block or 0) / 1000
+        while True:
+            response = self._client.xreadgroup(groupname, consumername, streams, count, None, noack)
+            if response or block is None or time.monotonic() >= deadline:
+                return response
+            await asyncio.sleep(0.001)
+
+    async def aclose(self) -> None:
+        pass
+
+    close = aclose
+
+
+def make_client(backend: str = 'redis', host: str = 'localhost', port: int = 6379, **kwargs):
+    """Synchronous client for the backend, in-memory clients with the same host:port share a keyspace"""
+    if backend == 'memory':
+        return MemoryRedis(MemoryStore.named(f'{host}:{port}'))
+    if backend == 'redis':
+        return redis.Redis(host=host, port=port, **kwargs)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+
+def make_async_client(backend: str = 'redis', host: str = 'localhost', port: int = 6379,
+                      connection_pool=None):
+    """asyncio client for the backend, a Redis client uses connection_pool when given"""
+    if backend == 'memory':
+        return AsyncMemoryRedis(MemoryStore.named(f'{host}:{port}'))
+    if backend == 'redis':
+        if connection_pool is not None:
+            return aredis.Redis(connection_pool=connection_pool)
+        return aredis.Redis(host=host, port=port)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
@@ -0,0 +1,105 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+
+import polars as pl
+from dotenv import load_dotenv
+load_dotenv()
+
+from create_tables import Store
+from generate_risk import Job, fetch_trades, generate_fo_risk_frame, insert_fo_risk_frame, insert_jobs, insert_tombstones
+from risk_delta import delta_risk_frame, risk_fingerprints
+
+# Intraday versions are spread evenly across the trading day
+DAY_START = time(8, 0)
+DAY_END = time(17, 0)
+
+
+def snapshot_dates(start: date, end: date, business_days_only: bool = True) -> List[date]:
+    """All dates in [start, end], optionally without weekends"""
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    if business_days_only:
+        days = [d for d in days if d.weekday() < 5]
+    return days
+
+
+def snapshot_times(asOfDate: date, versions: int) -> List[datetime]:
+    """calculatedAt for each intraday version of a day"""
+    open_at = datetime.combine(asOfDate, DAY_START)
+    step = (datetime.combine(asOfDate, DAY_END) - open_at) / max(versions, 1)
+    return [open_at + step * v for v in range(versions)]
+
+
+def trades_as_of(trades: pl.DataFrame, asOfDate: date) -> pl.DataFrame:
+    """The trades live on asOfDate: already traded and not yet matured"""
+    return trades.filter((pl.col('tradeDate') <= asOfDate)
+                         & (pl.col('maturityDate').is_null() | (pl.col('maturityDate') >= asOfDate)))
+
+
+def backfill_day(trades: pl.DataFrame, asOfDate: date, versions: int, delta: bool = False,
+                 day_count: Optional[str] = None) -> int:
+    """Generate and insert every intraday version for one day, returns rows written.
+
+    Only the trades live on asOfDate are priced. Each version's job row is
+    written with it, a version that fails leaves a FAILED job.
+    """
+    store = Store()
+    snapId = 'LIVE' + asOfDate.strftime("%Y%m%d")
+    trades = trades_as_of(trades, asOfDate)
+    rows = 0
+    fingerprints = None
+    try:
+        for version, calculatedAt in enumerate(snapshot_times(asOfDate, versions)):
+            job = Job.create_backfill(version, snapId, calculatedAt)
+            try:
+                risk = generate_fo_risk_frame(trades, snapId, version, asOfDate, calculatedAt, day_count=day_count)
+                previous = fingerprints
+                if delta:
+                    risk, fingerprints = delta_risk_frame(risk, previous)
+                else:
+                    fingerprints = risk_fingerprints(risk)
+                insert_fo_risk_frame(store.client, risk)
+                if previous is not None:
+                    insert_tombstones(store.client, previous['id'], fingerprints['id'], snapId, version,
+                                      asOfDate, calculatedAt)
+            except Exception:
+                job.fail()
+                insert_jobs(store.client, [job])
+                raise
+            job.complete(calculatedAt)
+            insert_jobs(store.client, [job])
+            rows += risk.height
+    finally:
+        store.close()
+    return rows
+
+
+def run_backfill(start: date, end: date, versions_per_day: int = 1,
+                 workers: Optional[int] = None, business_days_only: bool = True,
+                 delta: bool = False, day_count: Optional[str] = None) -> int:
+    """Backfill risk snapshots for a date range, one worker process per day in flight"""
+    store = Store()
+    trades = fetch_trades(store.client)
+    store.close()
+
+    days = snapshot_dates(start, end, business_days_only)
+    workers = workers or os.cpu_count()
+    print(f"Backfilling {len(days)} days x {versions_per_day} versions over {trades.height} trades with {workers} workers")
+
+    started = datetime.now()
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(backfill_day, trades, day, versions_per_day, delta, day_count): day for day in days}
+        for future in as_completed(futures):
+            rows = future.result()
+            total += rows
+            print(f"Backfilled {futures[future]}: {rows} risk records")
+
+    print(f"Inserted {total} risk records in {(datetime.now() - started).total_seconds():.1f} seconds")
+    return total
+
+
+if __name__ == "__main__":
+    today = datetime.now().date()
+    run_backfill(today - timedelta(days=30), today - timedelta(days=1), versions_per_day=4)
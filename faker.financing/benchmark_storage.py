@@ -0,0 +1,56 @@
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+from marketsim import SimulatorConfig
+from pricingservice import InstrumentPricingService, PricingConfig
+
+SAMPLE_KEYS = 1000
+
+
+async def measure_storage(storage: str, instrument_ids: List[str]) -> Dict[str, float]:
+    """Write the whole universe in one layout, then measure memory per instrument and full-board read rate"""
+    # No change stream, its entries would count towards used_memory per instrument
+    config = PricingConfig(storage=storage, batch_size=1000, simulator=SimulatorConfig(seed=1), stream_key=None)
+    service = InstrumentPricingService(config)
+    await service.connect_redis(clear=True)
+    try:
+        client = service.redis_client
+        used_before = (await client.info('memory'))['used_memory']
+        write = await service.update_all_instrument_prices(instrument_ids)
+        used_after = (await client.info('memory'))['used_memory']
+
+        sample = instrument_ids[:SAMPLE_KEYS]
+        async with client.pipeline(transaction=False) as pipe:
+            for inst_id in sample:
+                await pipe.memory_usage(f'{service.PRICE_PREFIX}{inst_id}')
+            key_bytes = [b for b in await pipe.execute() if b is not None]
+
+        start = time.perf_counter()
+        read = 0
+        async for records in service.iter_prices(chunk_size=1000):
+            read += len(records)
+        read_elapsed = time.perf_counter() - start
+    finally:
+        await service.close_redis()
+
+    return {
+        'storage': storage,
+        'instruments': len(instrument_ids),
+        'bytes_per_instrument': (used_after - used_before) / len(instrument_ids),
+        'memory_usage_per_key': sum(key_bytes) / max(len(key_bytes), 1),
+        'write_per_second': write.throughput,
+        'read_per_second': read / read_elapsed if read_elapsed else 0.0,
+    }
+
+
+async def main(instruments: int = 100_000) -> None:
+    instrument_ids = [f'INST_{i}' for i in range(instruments)]
+    # connect_redis(clear=True) starts each layout from no keys
+    results = [await measure_storage(storage, instrument_ids) for storage in ('hash', 'packed')]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
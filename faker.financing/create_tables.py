@@ -16,12 +16,14 @@ class Tables(enum.Enum):
     INSTRUMENTS = "ref_instruments"
     TRADES = "trades_trs"
     RISK = "risk_f"
+    RISK_SCENARIOS = "risk_scenarios"
     RISKVIEW = "risk_view"
     RISKVIEW_MV = "risk_view_mv"
     RISK_AGGREGATING_VIEW = "risk_agg"
     RISK_AGGREGATING_VIEW_MV = "risk_agg_mv"
     OVERRIDES = "overrides"
     JOBS = "jobs"
+    PRICES = "md_prices"
 
 @task(retries=0, cache_key_fn=None,persist_result=False)
 def create_db(store: Store) -> None:
@@ -137,6 +139,7 @@ def create_trades_tables(store: Store):
 
 @task(retries=0, cache_key_fn=None, persist_result=False)
 def create_risk_tables(store: Store):
+    """Every published version of every trade's risk; a removed trade gets an isDeleted tombstone row"""
     print(f"Creating {Tables.RISK.value} table")
     query = f"""
     CREATE TABLE IF NOT EXISTS {Tables.RISK.value} (
@@ -171,11 +174,11 @@ def create_risk_tables(store: Store):
     dtm Int64,
     tenor LowCardinality(String),
     mid Decimal(18,2),
-    fxSpot Decimal(18,2),
+    fxSpot Decimal(18,6),
     sideFactor LowCardinality(String),
     notional Decimal(18,2),
     ccyFunding LowCardinality(String),
-    fxspotFunding Decimal(18,2),
+    fxspotFunding Decimal(18,6),
     notionalFunding Decimal(18,2),
     iaAmount Decimal(18,2),
     cashOut Decimal(18,2),
@@ -186,15 +189,58 @@ def create_risk_tables(store: Store):
     accrualPast Decimal(18,2),
     calculatedAt DateTime,
     ead Decimal(18,2),
-    spread Decimal(18,2)
+    spread Decimal(18,2),
+    isDeleted UInt8 DEFAULT 0
 
+    ) ENGINE = ReplacingMergeTree()
+    ORDER BY (snapId, id, snapVersion)
+    """
+    store.client.command(query)
+    # IF NOT EXISTS keeps an older table's (id, snapId) key, under which merges collapse the versions
+    sorting_key = store.client.command(
+        "SELECT sorting_key FROM system.tables WHERE database = currentDatabase() AND name = %(name)s",
+        parameters={'name': Tables.RISK.value})
+    if sorting_key != 'snapId, id, snapVersion':
+        raise RuntimeError(f"{Tables.RISK.value} is ordered by ({sorting_key}), versions need "
+                           f"(snapId, id, snapVersion): drop and recreate it (create_tables.main recreates the database)")
+    store.client.command(f"ALTER TABLE {Tables.RISK.value} ADD COLUMN IF NOT EXISTS isDeleted UInt8 DEFAULT 0")
+    # fx rates were Decimal(18,2) before, CREATE ... IF NOT EXISTS leaves an existing table's types alone
+    store.client.command(f"""
+    ALTER TABLE {Tables.RISK.value}
+        MODIFY COLUMN fxSpot Decimal(18,6),
+        MODIFY COLUMN fxspotFunding Decimal(18,6)
+    """)
+
+@task(retries=0, cache_key_fn=None, persist_result=False)
+def create_risk_scenarios_table(store: Store):
+    print(f"Creating {Tables.RISK_SCENARIOS.value} table")
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {Tables.RISK_SCENARIOS.value} (
+        snapId String,
+        snapVersion Int64,
+        asOfDate Date,
+        scenarioId LowCardinality(String),
+        fxShock Float64,
+        spreadShock Float64,
+        haircutShock Float64,
+        book LowCardinality(String),
+        ccy LowCardinality(String),
+        trades UInt32,
+        ead Decimal(18,2),
+        cashOut Decimal(18,2),
+        accrualDaily Decimal(18,2),
+        accrualProjected Decimal(18,2),
+        accrualPast Decimal(18,2),
+        notionalFunding Decimal(18,2),
+        calculatedAt DateTime
     ) ENGINE = ReplacingMergeTree(snapVersion)
-    ORDER BY (id, snapId)
+    ORDER BY (snapId, scenarioId, book, ccy)
     """
     store.client.command(query)
 
 @task(retries=0, cache_key_fn=None, persist_result=False)
 def create_risk_view(store: Store):
+    """Latest version of each trade per snapshot with its reference data; read with FINAL and isDeleted = 0"""
     print(f"Creating {Tables.RISKVIEW.value} table")
     query = f"""
     CREATE TABLE IF NOT EXISTS {Tables.RISKVIEW.value} (
@@ -228,21 +274,26 @@ def create_risk_view(store: Store):
         accrualPast Decimal(18,2),
         cashOut Decimal(18,2),
         margin Decimal(18,2),
-        fxSpot Decimal(18,2),
+        fxSpot Decimal(18,6),
         marginFixed Decimal(18,2),
         spread Decimal(18,2),
-        ead Decimal(18,2)        
+        ead Decimal(18,2),
+        isDeleted UInt8 DEFAULT 0
 
     ) ENGINE = ReplacingMergeTree(snapVersion)
     ORDER BY (id,snapId)
     """
     store.client.command(query)
+    store.client.command(f"ALTER TABLE {Tables.RISKVIEW.value} MODIFY COLUMN fxSpot Decimal(18,6)")
+    store.client.command(f"ALTER TABLE {Tables.RISKVIEW.value} ADD COLUMN IF NOT EXISTS isDeleted UInt8 DEFAULT 0")
 
 @task(retries=0, cache_key_fn=None, persist_result=False)
 def create_risk_view_mv(store: Store):
     print(f"Creating {Tables.RISKVIEW_MV.value} materialized view")
+    # The view holds no data, recreating it picks up a changed definition
+    store.client.command(f"DROP VIEW IF EXISTS {Tables.RISKVIEW_MV.value}")
     query = f"""
-    CREATE MATERIALIZED VIEW risk_view_mv TO risk_view
+    CREATE MATERIALIZED VIEW {Tables.RISKVIEW_MV.value} TO {Tables.RISKVIEW.value}
     AS SELECT 
         r.id as id,
         r.eventId as eventId,
@@ -278,12 +329,15 @@ def create_risk_view_mv(store: Store):
         r.fxSpot,
         r.marginFixed,
         r.spread,
-        r.ead
+        r.ead,
+        r.isDeleted
 
     FROM {Tables.RISK.value} as r 
-    INNER JOIN {Tables.COUNTERPARTIES.value} cp ON r.counterparty = cp.id
-    INNER JOIN {Tables.HMSBOOKS.value} hms ON r.book = hms.book
-    INNER JOIN {Tables.INSTRUMENTS.value} inst ON r.instrumentId = inst.id
+    LEFT JOIN {Tables.COUNTERPARTIES.value} cp ON r.counterparty = cp.id
+    LEFT JOIN {Tables.HMSBOOKS.value} hms ON r.book = hms.book
+    LEFT JOIN {Tables.INSTRUMENTS.value} inst ON r.instrumentId = inst.id
+    -- tombstones carry no reference data but must replace the trade's row, live rows still need all three
+    WHERE r.isDeleted = 1 OR (cp.id != '' AND hms.book != '' AND inst.id != '')
     """
     store.client.command(query)
 
@@ -310,6 +364,7 @@ def create_overrides(store: Store):
 
 @task(retries=0, cache_key_fn=None, persist_result=False)
 def create_jobs_table(store: Store):
+    """One row per (snapId, jobType, snapVersion), a status update re-inserts the job and the last insert wins"""
     print(f"Creating {Tables.JOBS.value} table")
     query = f"""
     CREATE TABLE IF NOT EXISTS {Tables.JOBS.value} (
@@ -317,12 +372,31 @@ def create_jobs_table(store: Store):
         eventId Int64,
         jobType LowCardinality(String),
         snapId String,
-        snapVersion UInt8,
+        snapVersion Int64,
         status LowCardinality(String),
         createdAt DateTime,
         completedAt Nullable(DateTime)
-    ) ENGINE = ReplacingMergeTree(snapVersion)
-    ORDER BY (snapId,jobType);
+    ) ENGINE = ReplacingMergeTree()
+    ORDER BY (snapId,jobType,snapVersion);
+    """
+    store.client.command(query)
+
+@task(retries=0, cache_key_fn=None, persist_result=False)
+def create_prices_table(store: Store):
+    """Tick history written by the pricing service's TickSink, one row per changed price"""
+    print(f"Creating {Tables.PRICES.value} table")
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {Tables.PRICES.value} (
+        instrumentId LowCardinality(String),
+        ts DateTime64(9) CODEC(DoubleDelta, ZSTD(1)),
+        last Float64 CODEC(Gorilla, ZSTD(1)),
+        bid Float64 CODEC(Gorilla, ZSTD(1)),
+        ask Float64 CODEC(Gorilla, ZSTD(1)),
+        spread Float64 CODEC(Gorilla, ZSTD(1)),
+        yest Float64 CODEC(Gorilla, ZSTD(1))
+    ) ENGINE = MergeTree()
+    PARTITION BY toDate(ts)
+    ORDER BY (instrumentId, ts);
     """
     store.client.command(query)
 
@@ -336,9 +410,11 @@ def main():
     create_instruments_tables(store)
     create_trades_tables(store)
     create_risk_tables(store)
+    create_risk_scenarios_table(store)
     create_risk_view(store)
     create_risk_view_mv(store)
     create_overrides(store)
+    create_prices_table(store)
    
     store.close()
 
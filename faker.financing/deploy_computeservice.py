@@ -1,14 +1,20 @@
 from prefect import flow, task, serve
+from prefect.client.schemas.objects import ConcurrencyLimitConfig, ConcurrencyLimitStrategy
 from prefect.client.schemas.schedules import CronSchedule
 from datetime import datetime
 import time
 import pytz
+import signal
 from typing import Optional, Any
 from dotenv import load_dotenv
 import logging
 import os
 import asyncio
-from pricingservice import InstrumentPricingService
+from create_tables import Store
+from marketsim import SimulatorConfig
+from pricingservice import InstrumentPricingService, PricingConfig
+from ticksink import TickSink
+from universe import SYNC_INTERVAL, InstrumentUniverse
 
 # Configuration
 NY_TIMEZONE = pytz.timezone('America/New_York')
@@ -20,6 +26,11 @@ DEFAULT_RETRY_CONFIG = {
     'max_retries': 3,
     'retry_delay': 60
 }
+# Seconds between health reports, the Redis heartbeat expires after three missed reports
+HEALTH_INTERVAL = 60
+HEARTBEAT_KEY = 'pricing:heartbeat'
+# Consecutive cycles with every batch failing before the worker gives up and lets Prefect retry it
+MAX_FAILED_CYCLES = 10
 
 # Configure logging
 logging.basicConfig(
@@ -28,109 +39,151 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@task
-def check_business_hours() -> bool:
-    """Check if current time is within business hours"""
+def within_business_hours() -> bool:
     current_time = datetime.now(NY_TIMEZONE).time()
     return BUSINESS_HOURS['start'] <= current_time <= BUSINESS_HOURS['end']
 
-@task(retries=3, retry_delay_seconds=30)
-async def your_business_logic() -> bool:
-    await asyncio.sleep(1)
 
-    # Sample instrument IDs
-    instrument_ids = [f'INST_{i}' for i in range(1, 10000)]
-
-    # Initialize service with connection pool settings
-    pricing_service = InstrumentPricingService(
-        pool_size=100,  # Adjust based on your needs
-        pool_timeout=30
-    )
-    
+@task
+def check_business_hours() -> bool:
+    """Check if current time is within business hours"""
+    return within_business_hours()
+
+
+async def run_resident_worker(config: PricingConfig, stop: asyncio.Event,
+                              instrument_ids: Optional[list[str]] = None,
+                              record_ticks: bool = True) -> dict[str, Any]:
+    """Price on fixed-rate ticks until stop is set or business hours end.
+
+    Without instrument_ids the universe comes from ref_instruments and is
+    synced every SYNC_INTERVAL seconds. The service, its connection pool and
+    simulator live for the whole session; a restart resumes from the prices
+    and snapshot left behind. With record_ticks every written price also
+    goes to md_prices through a TickSink.
+    """
+    pricing_service = InstrumentPricingService(config)
+    universe = None
+    store = None
+    sink = TickSink() if record_ticks else None
+    totals = {'cycles': 0, 'updated': 0, 'failed_batches': 0, 'timed_out_batches': 0}
+    failed_cycles = 0
     try:
-        # Connect to Redis (now using connection pool)
         await pricing_service.connect_redis()
-
-        # Process instruments in batches to manage connections
-        batch_size = 1000
-        for i in range(0, len(instrument_ids), batch_size):
-            batch = instrument_ids[i:i + batch_size]
-            
-            # Update batch of instrument prices
-            await pricing_service.update_all_instrument_prices(batch)
-            
-            # Optional: Add small delay between batches
-            await asyncio.sleep(0.1)
-
-        # Retrieve and print updated prices
-        details = await pricing_service.get_instrument_details()
-
+        if sink is not None:
+            sink.start()
+            pricing_service.listeners.append(sink)
+        if instrument_ids is None:
+            store = Store()
+            universe = InstrumentUniverse(pricing_service, store.client)
+            universe.load()
+            instrument_ids = universe.instrument_ids
+            logger.info(f"Loaded {len(universe)} instruments from ref_instruments up to {universe.watermark}")
+        restored = await pricing_service.warm_start(instrument_ids)
+        logger.info(f"Pricing worker started, {restored} instruments restored at sequence {pricing_service.sequence}")
+
+        deadline = time.monotonic()
+        next_report = deadline + HEALTH_INTERVAL
+        next_sync = deadline + SYNC_INTERVAL
+        while not stop.is_set() and within_business_hours():
+            if universe is not None and time.monotonic() >= next_sync:
+                change = await universe.sync()
+                if change:
+                    logger.info(f"Universe sync: {change}")
+                instrument_ids = universe.instrument_ids
+                next_sync += SYNC_INTERVAL
+            stats = await pricing_service.update_all_instrument_prices(instrument_ids)
+            totals['cycles'] += 1
+            totals['updated'] += stats.updated
+            totals['failed_batches'] += stats.failed
+            totals['timed_out_batches'] += stats.timed_out
+
+            failed_cycles = failed_cycles + 1 if stats.batches and stats.failed + stats.timed_out == stats.batches else 0
+            if failed_cycles >= MAX_FAILED_CYCLES:
+                raise RuntimeError(f"{failed_cycles} consecutive pricing cycles failed, last: {stats}")
+
+            if time.monotonic() >= next_report:
+                logger.info(f"Pricing cycle {pricing_service.sequence}: {stats}")
+                if sink is not None:
+                    logger.info(f"Tick history: {sink.written} written, {sink.dropped} dropped, {sink.failed} failed")
+                await pricing_service.redis_client.set(HEARTBEAT_KEY, datetime.now().isoformat(), ex=3 * HEALTH_INTERVAL)
+                next_report += HEALTH_INTERVAL
+
+            deadline = max(deadline + config.update_interval, time.monotonic())
+            try:
+                # Wake at the next tick, or at once when asked to stop
+                await asyncio.wait_for(stop.wait(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
     finally:
-        # Ensure Redis connection is closed
+        if sink is not None:
+            sink.stop()
+            totals['ticks_written'] = sink.written
+        pricing_service.snapshot()
         await pricing_service.close_redis()
+        if store is not None:
+            store.close()
 
-    logger.info("Business logic completed")
-    return True
+    logger.info(f"Pricing worker stopped after {totals['cycles']} cycles")
+    return totals
 
-@task
-def handle_failure(
-    error: Exception,
-    retry_count: int,
-    max_retries: int = DEFAULT_RETRY_CONFIG['max_retries'],
-    retry_delay: int = DEFAULT_RETRY_CONFIG['retry_delay']
-) -> bool:
-    """Handle task failure with automatic restart"""
-    if retry_count >= max_retries:
-        logger.error(f"Maximum retries ({max_retries}) reached. Please check the system.")
-        return False
-    
-    logger.error(f"Process failed with error: {str(error)}")
-    logger.info(f"Attempting restart {retry_count + 1}/{max_retries} in {retry_delay} seconds...")
-    time.sleep(retry_delay)
-    return True
-
-@flow(name="Business Hours Flow", retries=3)
-async def business_hours_flow(
-    max_retries: int = DEFAULT_RETRY_CONFIG['max_retries'],
-    retry_delay: int = DEFAULT_RETRY_CONFIG['retry_delay']
+
+@flow(name="Resident Pricing Worker", retries=DEFAULT_RETRY_CONFIG['max_retries'],
+      retry_delay_seconds=DEFAULT_RETRY_CONFIG['retry_delay'])
+async def resident_pricing_flow(
+    update_interval: int = 1,
+    snapshot_path: Optional[str] = 'pricing_state.npz',
+    record_ticks: bool = True
 ):
-    """Main flow that runs only during business hours"""
+    """Long-lived pricing worker for the trading day, Prefect only starts, retries and tracks it"""
     if not check_business_hours():
         logger.info(f"Outside business hours at {datetime.now(NY_TIMEZONE)}, skipping execution")
         return None
 
-    for retry_count in range(max_retries + 1):
+    config = PricingConfig(
+        pool_size=100,
+        pool_timeout=30,
+        batch_size=1000,
+        update_interval=update_interval,
+        simulator=SimulatorConfig(),
+        snapshot_path=snapshot_path
+    )
+
+    # Cancellation and shutdown stop the worker between cycles so the snapshot is written
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
         try:
-            result = await your_business_logic()
-            logger.info(f"Task executed successfully at {datetime.now(NY_TIMEZONE)}")
-            return result
-        except Exception as e:
-            should_continue = handle_failure(e, retry_count, max_retries, retry_delay)
-            if not should_continue:
-                break 
-    
-    return False
-
-# Schedule to run every minute
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    totals = await run_resident_worker(config, stop, record_ticks=record_ticks)
+    logger.info(f"Worker session completed at {datetime.now(NY_TIMEZONE)}: {totals}")
+    return totals
+
+
+# Start at the open; the later slots only matter if the worker died, a running one cancels them
 schedule = CronSchedule(
-    cron="* * * * *",  # Every minute
+    cron="0,15,30,45 8-16 * * 1-5",
     timezone="America/New_York"
 )
 
 def create_and_apply_deployment():
-    
+
     serve(
-        business_hours_flow.to_deployment(
-            name="business-hours-deployment",
-            cron='* * * * *',
+        resident_pricing_flow.to_deployment(
+            name="resident-pricing-worker",
+            schedule=schedule,
             parameters={
-                "max_retries": 3,
-                "retry_delay": 60
-            }
+                "update_interval": 1
+            },
+            concurrency_limit=ConcurrencyLimitConfig(
+                limit=1,
+                collision_strategy=ConcurrencyLimitStrategy.CANCEL_NEW
+            )
         )
     )
 
 if __name__ == "__main__":
     # Remove load_dotenv() here since it's now in create_and_apply_deployment()
     create_and_apply_deployment()
-    
\ No newline at end of file
@@ -2,11 +2,14 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from prefect import flow, serve
-from create_tables import create_db, create_counterparty_tables, create_hms_tables, create_instruments_tables, create_trades_tables, create_risk_tables, create_risk_view, create_risk_view_mv, create_overrides, create_jobs_table, Store
+from create_tables import create_db, create_counterparty_tables, create_hms_tables, create_instruments_tables, create_trades_tables, create_risk_tables, create_risk_scenarios_table, create_risk_view, create_risk_view_mv, create_overrides, create_jobs_table, create_prices_table, Store
 from generate_refdata import load_hms_data, load_counterparty_data, load_instrument_data
 from generate_trades import generate_fo_trades_trs, load_trades_to_clickhouse
 from generate_risk import run_risk
-from datetime import timedelta
+from backfill_risk import run_backfill
+from risk_scenarios import run_scenarios
+from datetime import date, timedelta
+from typing import Optional
 
 
 @flow(log_prints=True, persist_result=False, cache_result_in_memory=False)
@@ -25,10 +28,12 @@ def create_tables():
     create_instruments_tables(store)
     create_trades_tables(store)
     create_risk_tables(store)
+    create_risk_scenarios_table(store)
     create_risk_view(store)
     create_risk_view_mv(store)
     create_overrides(store)
     create_jobs_table(store)
+    create_prices_table(store)
     store.close()
 
 
@@ -50,8 +55,19 @@ def load_trades():
 
 
 @flow(log_prints=True, persist_result=False, cache_result_in_memory=False)
-def generate_risk():
-    run_risk()
+def generate_risk(delta: bool = False, day_count: Optional[str] = None):
+    run_risk(delta=delta, day_count=day_count)
+
+
+@flow(log_prints=True, persist_result=False, cache_result_in_memory=False)
+def generate_scenarios(day_count: Optional[str] = None):
+    run_scenarios(day_count=day_count)
+
+
+@flow(log_prints=True, persist_result=False, cache_result_in_memory=False)
+def backfill_risk(start: date, end: date, versions_per_day: int = 4, workers: int = 4,
+                  day_count: Optional[str] = None):
+    run_backfill(start, end, versions_per_day=versions_per_day, workers=workers, day_count=day_count)
 
 
 if __name__ == "__main__":
@@ -65,7 +81,11 @@ if __name__ == "__main__":
         load_trades.to_deployment(
             name="load_trades"),
         generate_risk.to_deployment(
-            name="generate_risk", interval=timedelta(minutes=1))
+            name="generate_risk", interval=timedelta(minutes=1)),
+        generate_scenarios.to_deployment(
+            name="generate_scenarios"),
+        backfill_risk.to_deployment(
+            name="backfill_risk")
         )
 
     print("Done")
@@ -0,0 +1,103 @@
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import polars as pl
+import redis
+from backends import make_client
+
+FX_KEY = 'fx:USD'
+# Seconds a snapshot's published matrix is kept, long enough for a day's versions and reruns
+SNAPSHOT_TTL = 7 * 24 * 3600
+# USD value of one unit of currency, centre of the generated rates
+REFERENCE_USD_RATES = {
+    'USD': 1.0, 'EUR': 1.08, 'GBP': 1.27, 'JPY': 0.0067, 'CHF': 1.13,
+    'CAD': 0.73, 'AUD': 0.66, 'HKD': 0.128, 'CNY': 0.138, 'SGD': 0.74,
+}
+
+
+class FxRateMatrix:
+    """Cross rates for a fixed set of currencies, built once per snapshot.
+
+    ``matrix[i, j]`` is the number of units of currency j for one unit of
+    currency i, so converting an amount from i to j is a single multiply.
+    """
+
+    def __init__(self, usd_rates: Dict[str, float]):
+        self.currencies = sorted(usd_rates)
+        usd = np.array([usd_rates[c] for c in self.currencies], dtype=np.float64)
+        self.matrix = usd[:, None] / usd[None, :]
+        self._enum = pl.Enum(self.currencies)
+
+    @classmethod
+    def generated(cls, currencies: Sequence[str], seed=None, volatility: float = 0.01) -> 'FxRateMatrix':
+        """Random rates around REFERENCE_USD_RATES, unknown currencies get a random level"""
+        rng = np.random.default_rng(seed)
+        currencies = sorted(set(currencies) | {'USD'})
+        levels = np.array([REFERENCE_USD_RATES.get(c, np.nan) for c in currencies])
+        unknown = np.isnan(levels)
+        levels[unknown] = np.exp(rng.uniform(np.log(0.005), np.log(2.0), unknown.sum()))
+        rates = levels * np.exp(rng.normal(0.0, volatility, len(currencies)))
+        rates[currencies.index('USD')] = 1.0
+        return cls(dict(zip(currencies, rates)))
+
+    @classmethod
+    def from_redis(cls, client: redis.Redis, key: str = FX_KEY) -> Optional['FxRateMatrix']:
+        """Rates published under key as currency -> USD value, or None if there are none"""
+        rates = client.hgetall(key)
+        if not rates:
+            return None
+        return cls({k.decode(): float(v) for k, v in rates.items()})
+
+    @classmethod
+    def load(cls, currencies: Sequence[str], client: Optional[redis.Redis] = None, seed=None) -> 'FxRateMatrix':
+        """Rates from Redis when every currency is published there, generated rates otherwise"""
+        try:
+            client = client or make_client('redis', 'localhost', 6379)
+            fx = cls.from_redis(client)
+            if fx is not None and set(currencies) <= set(fx.currencies):
+                return fx
+        except redis.RedisError as e:
+            print(f"FX rates unavailable from Redis, generating: {e}")
+        return cls.generated(currencies, seed)
+
+    @classmethod
+    def for_snapshot(cls, snapId: str, currencies: Sequence[str], client: Optional[redis.Redis] = None,
+                     seed=None) -> 'FxRateMatrix':
+        """The one matrix of a snapshot, published under FX_KEY:snapId by the first version that needs it.
+
+        Later versions read it back, so a snapshot's rates only move when a
+        new currency has to be added; the published rates are kept as they are.
+        """
+        key = f'{FX_KEY}:{snapId}'
+        try:
+            client = client or make_client('redis', 'localhost', 6379)
+            published = cls.from_redis(client, key)
+            if published is not None and set(currencies) <= set(published.currencies):
+                return published
+            fx = cls.load(currencies, client, seed)
+            if published is not None:
+                fx = cls({**fx.usd_rates(), **published.usd_rates()})
+            fx.to_redis(client, key)
+            client.expire(key, SNAPSHOT_TTL)
+            return fx
+        except redis.RedisError as e:
+            print(f"FX rates for {snapId} unavailable from Redis, generating: {e}")
+            return cls.generated(currencies, seed)
+
+    def usd_rates(self) -> Dict[str, float]:
+        """USD value of one unit of each currency"""
+        if 'USD' not in self.currencies:
+            raise ValueError("FX matrix has no USD leg to publish against")
+        usd = self.currencies.index('USD')
+        return {c: float(self.matrix[i, usd]) for i, c in enumerate(self.currencies)}
+
+    def to_redis(self, client: redis.Redis, key: str = FX_KEY) -> None:
+        client.hset(key, mapping=self.usd_rates())
+
+    def codes(self, currencies: pl.Series) -> np.ndarray:
+        """Integer code per value, raises if a currency is not in the matrix"""
+        return currencies.cast(pl.Utf8).cast(self._enum).to_physical().to_numpy()
+
+    def rates(self, from_ccy: pl.Series, to_ccy: str) -> np.ndarray:
+        """Rate from each value of from_ccy into to_ccy"""
+        return self.matrix[self.codes(from_ccy), self.currencies.index(to_ccy)]
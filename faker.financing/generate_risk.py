@@ -1,13 +1,13 @@
 import uuid,time
-import random
-from datetime import datetime
+import zlib
+from datetime import date, datetime
 from clickhouse_connect import get_client
-from decimal import Decimal
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Tuple
 import polars as pl
 from create_tables import Store,Tables
-client = Store().client
+from risk_delta import FingerprintCache, delta_risk_frame, live_ids, removed_ids, risk_fingerprints, tombstone_frame
+from fxservice import FxRateMatrix
 import numpy as np
 
 @dataclass
@@ -31,14 +31,25 @@ class Job:
             createdAt=datetime.now(),
            
         )
+
+    @classmethod
+    def create_backfill(cls, version: int, snapId: str, createdAt: datetime) -> 'Job':
+        return cls(
+            id=str(uuid.uuid4()),
+            snapId=snapId,
+            snapVersion=version,
+            jobType='BACKFILL',
+            status='RUNNING',
+            createdAt=createdAt,
+        )
     
-    def complete(self) -> None:
+    def complete(self, completedAt: Optional[datetime] = None) -> None:
         self.status = 'COMPLETED'
-        self.completed_at = datetime.now()
+        self.completedAt = completedAt or datetime.now()
     
     def fail(self) -> None:
         self.status = 'FAILED'
-        self.completed_at = datetime.now()
+        self.completedAt = datetime.now()
     
     def to_dict(self) -> dict:
         return {
@@ -51,68 +62,220 @@ class Job:
             'completedAt': self.completedAt if self.completedAt else datetime.now()
         }
 
-def generate_fo_risk_data(client,snapId,snapVersion):
-    trades = client.query("SELECT * FROM "+Tables.TRADES.value + " final")
+RISK_STATUSES = ['ACTIVE', 'PENDING', 'SETTLED']
+SUB_TYPES = ['SWAP', 'FORWARD', 'OPTION']
+PRODUCT_TYPES = ['IR', 'FX', 'EQUITY']
+SIDES = ['BUY', 'SELL']
+MODELS = ['BLACK_SCHOLES', 'MONTE_CARLO', 'BINOMIAL']
+TENORS = ['1M', '3M', '6M', '1Y']
+SIDE_FACTORS = ['1', '-1']
+
+EAD_FACTOR = 0.4
+IA_FACTOR = 0.1
+PROJECTED_DAYS = 150
+PAST_DAYS = 90
+
+# day-count convention -> days in the year fraction denominator
+DAY_COUNTS = {'ACT/360': 360, 'ACT/365F': 365, '30/360': 360}
+SETTLEMENT_DAYS = 2
+FUNDING_CCY = 'USD'
+# upper bound in days to maturity for each tenor bucket, the last bucket is open ended
+TENOR_BUCKETS = [(30, '1M'), (90, '3M'), (180, '6M'), (365, '1Y'), (730, '2Y'), (1825, '5Y')]
+LONG_TENOR = '10Y'
+
+# risk_f columns stored as Decimal(18,2); rounded before insert so the frame
+# holds exactly what ClickHouse will keep
+DECIMAL_COLUMNS = [
+    'notionalCcy', 'notionalAmount', 'firstReset', 'haircutManual', 'bondcfFactor',
+    'iaimAmount', 'notionalFundingCcy', 'marginOis', 'marginFixed', 'marginFloat',
+    'mid', 'notional', 'notionalFunding', 'iaAmount',
+    'cashOut', 'haircut', 'margin', 'accrualDaily', 'accrualProjected', 'accrualPast',
+    'ead', 'spread',
+]
+# fx rates are stored as Decimal(18,6)
+FX_COLUMNS = ['fxSpot', 'fxspotFunding']
+
+
+def fetch_trades(client) -> pl.DataFrame:
+    """Load the current trade book as a polars frame in one Arrow query"""
+    trades = pl.from_arrow(client.query_arrow("SELECT * FROM " + Tables.TRADES.value + " final"))
+    return trades.with_columns(
+        pl.col('id', 'counterparty', 'instrument', 'book', 'currency').cast(pl.Utf8),
+        pl.col('notionalAmount', 'financingSpread').cast(pl.Float64),
+    )
+
+
+def _trade_uniform(ids: pl.Series, salt: int) -> np.ndarray:
+    """Uniform [0, 1) draw per trade, stable for a trade id across snapshots"""
+    hashed = ids.hash(seed=salt).to_numpy()
+    return (hashed >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def _trade_choice(ids: pl.Series, salt: int, options: list) -> np.ndarray:
+    index = (_trade_uniform(ids, salt) * len(options)).astype(np.int64)
+    return np.asarray(options)[index]
+
+
+def snapshot_seed(snapId: str) -> int:
+    """Seed of a snapshot's market marks, the same for every version of snapId"""
+    return zlib.crc32(snapId.encode())
+
+
+def _year_fraction(start: pl.Expr, end: pl.Expr, day_count: str) -> pl.Expr:
+    if day_count == '30/360':
+        # bond basis: day 31 rolls to 30, and the end day only when the start day did
+        y1, m1, d1 = (part.cast(pl.Int32) for part in (start.dt.year(), start.dt.month(), start.dt.day()))
+        y2, m2, d2 = (part.cast(pl.Int32) for part in (end.dt.year(), end.dt.month(), end.dt.day()))
+        d1 = pl.min_horizontal(d1, 30)
+        d2 = pl.when((d1 == 30) & (d2 == 31)).then(30).otherwise(d2)
+        days = 360 * (y2 - y1) + 30 * (m2 - m1) + (d2 - d1)
+    else:
+        days = (end - start).dt.total_days()
+    return days.cast(pl.Float64) / DAY_COUNTS[day_count]
+
+
+def accrual_fractions(trades: pl.DataFrame, asOfDate: date,
+                      day_count: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Daily, past and projected accrual year fractions per trade.
+
+    Without a day count the fixed 90/150 day multipliers on ACT/365 are used;
+    with one, past accrual runs from tradeDate to asOfDate and projected
+    accrual from asOfDate to maturityDate.
+    """
+    n = trades.height
+    if day_count is None:
+        return np.full(n, 1 / 365), np.full(n, PAST_DAYS / 365), np.full(n, PROJECTED_DAYS / 365)
+    if day_count not in DAY_COUNTS:
+        raise ValueError(f"Unknown day count {day_count}, expected one of {list(DAY_COUNTS)}")
+
+    as_of = pl.lit(asOfDate)
+    start, end = pl.col('tradeDate'), pl.col('maturityDate')
+    fractions = trades.select(
+        _year_fraction(start, pl.min_horizontal(as_of, end), day_count).clip(lower_bound=0).alias('past'),
+        _year_fraction(pl.max_horizontal(as_of, start), end, day_count).clip(lower_bound=0).alias('projected'),
+    )
+    return np.full(n, 1 / DAY_COUNTS[day_count]), fractions['past'].to_numpy(), fractions['projected'].to_numpy()
+
+
+def trade_schedule(trades: pl.DataFrame, asOfDate: date) -> pl.DataFrame:
+    """tradeDt, settlementDt, maturityDt, dtm and tenor bucket from the trade's own dates"""
+    dtm = (pl.col('maturityDate') - pl.lit(asOfDate)).dt.total_days().clip(lower_bound=0)
+    tenor = pl.lit(LONG_TENOR)
+    for limit, bucket in reversed(TENOR_BUCKETS):
+        tenor = pl.when(dtm <= limit).then(pl.lit(bucket)).otherwise(tenor)
+    return trades.select(
+        pl.col('tradeDate').alias('tradeDt'),
+        (pl.col('tradeDate') + pl.duration(days=SETTLEMENT_DAYS)).alias('settlementDt'),
+        pl.col('maturityDate').alias('maturityDt'),
+        dtm.cast(pl.Int64).alias('dtm'),
+        tenor.alias('tenor'),
+    )
+
+
+def generate_fo_risk_frame(trades: pl.DataFrame, snapId: str, snapVersion: int,
+                           asOfDate: Optional[date] = None,
+                           calculatedAt: Optional[datetime] = None,
+                           seed: Optional[int] = None, day_count: Optional[str] = None,
+                           fx: Optional[FxRateMatrix] = None,
+                           funding_ccy: str = FUNDING_CCY) -> pl.DataFrame:
+    """Build a risk snapshot for every trade at once, one row per trade.
+
+    Trade terms (status, product, margins, haircuts, ...) are derived from the
+    trade id so they stay put between versions. Market marks (mid, and fx
+    rates when no matrix is given) come from the trade id and ``seed``,
+    snapshot_seed(snapId) by default, so a trade's row only changes between
+    versions of a snapshot when its trade or the fx matrix does. fxSpot and
+    fxspotFunding convert the trade currency into funding_ccy through one
+    rate matrix for the whole snapshot. With a day_count, dates, dtm, tenor
+    and accruals come from the trade's tradeDate and maturityDate.
+    """
+    calculatedAt = calculatedAt or datetime.now()
+    asOfDate = asOfDate or calculatedAt.date()
+    seed = snapshot_seed(snapId) if seed is None else seed
+    ids = trades['id']
+
+    notional = trades['notionalAmount'].to_numpy()
+    spread = trades['financingSpread'].to_numpy()
+    if fx is None:
+        fx = FxRateMatrix.generated(trades['currency'].unique().to_list() + [funding_ccy], seed)
+    fx_spot = fx.rates(trades['currency'], funding_ccy)
+    daily, past, projected = accrual_fractions(trades, asOfDate, day_count)
+    if day_count is None:
+        schedule = pl.DataFrame({
+            'tradeDt': asOfDate,
+            'settlementDt': asOfDate,
+            'maturityDt': asOfDate,
+            'dtm': 1 + (_trade_uniform(ids, 12) * 365).astype(np.int64),
+            'tenor': _trade_choice(ids, 13, TENORS),
+        })
+    else:
+        schedule = trade_schedule(trades, asOfDate)
+    # eventId is the snapVersion digits followed by the trade's eventId digits
+    event_ids = trades.select(
+        (pl.lit(str(snapVersion)) + pl.col('eventId').cast(pl.Utf8)).cast(pl.Int64)
+    ).to_series()
+
+    risk = pl.DataFrame({
+        'id': ids,
+        'eventId': event_ids,
+        'snapId': snapId,
+        'snapVersion': snapVersion,
+        'asOfDate': asOfDate,
+        'status': _trade_choice(ids, 1, RISK_STATUSES),
+        'book': trades['book'],
+        'counterparty': trades['counterparty'],
+        'tradeDt': schedule['tradeDt'],
+        'settlementDt': schedule['settlementDt'],
+        'maturityDt': schedule['maturityDt'],
+        'notionalCcy': notional,
+        'notionalAmount': notional,
+        'firstReset': 0.01 + 0.04 * _trade_uniform(ids, 2),
+        'subType': _trade_choice(ids, 3, SUB_TYPES),
+        'productType': _trade_choice(ids, 4, PRODUCT_TYPES),
+        'ccy': trades['currency'],
+        'haircutManual': 0.1 * _trade_uniform(ids, 5),
+        'bondcfFactor': 0.8 + 0.4 * _trade_uniform(ids, 6),
+        'iaimAmount': notional * IA_FACTOR,
+        'iaimCcy': trades['currency'],
+        'side': _trade_choice(ids, 7, SIDES),
+        'model': _trade_choice(ids, 8, MODELS),
+        'notionalFundingCcy': notional * fx_spot,
+        'marginOis': 0.02 * _trade_uniform(ids, 9),
+        'marginFixed': 0.05 * _trade_uniform(ids, 10),
+        'marginFloat': 0.03 * _trade_uniform(ids, 11),
+        'instrumentId': trades['instrument'],
+        'dtm': schedule['dtm'],
+        'tenor': schedule['tenor'],
+        'mid': 95 + 10 * _trade_uniform(ids, seed),
+        'fxSpot': fx_spot,
+        'sideFactor': _trade_choice(ids, 14, SIDE_FACTORS),
+        'notional': notional,
+        'ccyFunding': funding_ccy,
+        'fxspotFunding': fx_spot,
+        'notionalFunding': notional * fx_spot,
+        'iaAmount': notional * IA_FACTOR,
+        'cashOut': notional * _trade_uniform(ids, 15),
+        'haircut': 0.1 * _trade_uniform(ids, 16),
+        'margin': 0.05 * _trade_uniform(ids, 17),
+        'accrualDaily': spread * notional * daily,
+        'accrualProjected': spread * notional * projected,
+        'accrualPast': spread * notional * past,
+        'calculatedAt': calculatedAt,
+        'ead': notional * EAD_FACTOR,
+        'spread': spread,
+    })
+    return risk.with_columns(
+        pl.col('snapVersion').cast(pl.Int64),
+        pl.col(DECIMAL_COLUMNS).round(2),
+        pl.col(FX_COLUMNS).round(6),
+    )
+
+
+def generate_fo_risk_data(client, snapId, snapVersion):
+    trades = fetch_trades(client)
     print(trades)
-    risk_data = []
-    for trade in trades.named_results():
-        # Calculate some base values for consistency
-        notional_amount = Decimal(str(trade['notionalAmount']))
-        fx_spot = Decimal(str(random.uniform(0.5, 2.0)))
-        spread = Decimal(str(trade['financingSpread']))
-        
-        risk_record = {
-            'id': trade['id'],
-            'eventId': np.int64(str(snapVersion) + str(trade['eventId'])),
-            'snapId': snapId,
-            'snapVersion': snapVersion,
-            'asOfDate': datetime.now().date(),
-            'status': random.choice(['ACTIVE', 'PENDING', 'SETTLED']),
-            'book': trade['book'],
-            'counterparty': trade['counterparty'],
-            'tradeDt': datetime.now().date(),
-            'settlementDt': datetime.now().date(),
-            'maturityDt': datetime.now().date(),
-            'notionalCcy': notional_amount,
-            'notionalAmount': notional_amount,
-            'firstReset': Decimal(str(random.uniform(0.01, 0.05))),
-            'subType': random.choice(['SWAP', 'FORWARD', 'OPTION']),
-            'productType': random.choice(['IR', 'FX', 'EQUITY']),
-            'ccy': trade['currency'],
-            'haircutManual': Decimal(str(random.uniform(0, 0.1))),
-            'bondcfFactor': Decimal(str(random.uniform(0.8, 1.2))),
-            'iaimAmount': notional_amount * Decimal('0.1'),
-            'iaimCcy': trade['currency'],
-            'side': random.choice(['BUY', 'SELL']),
-            'model': random.choice(['BLACK_SCHOLES', 'MONTE_CARLO', 'BINOMIAL']),
-            'notionalFundingCcy': notional_amount * fx_spot,
-            'marginOis': Decimal(str(random.uniform(0, 0.02))),
-            'marginFixed': Decimal(str(random.uniform(0, 0.05))),
-            'marginFloat': Decimal(str(random.uniform(0, 0.03))),
-            'instrumentId': trade['instrument'],
-            'dtm': random.randint(1, 365),
-            'tenor': random.choice(['1M', '3M', '6M', '1Y']),
-            'mid': Decimal(str(random.uniform(95, 105))),
-            'fxSpot': fx_spot,
-            'sideFactor': random.choice(['1', '-1']),
-            'notional': notional_amount,
-            'ccyFunding': trade['currency'],
-            'fxspotFunding': fx_spot,
-            'notionalFunding': notional_amount * fx_spot,
-            'iaAmount': notional_amount * Decimal('0.1'),
-            'cashOut': Decimal(str(random.uniform(0, float(notional_amount)))),
-            'haircut': Decimal(str(random.uniform(0, 0.1))),
-            'margin': Decimal(str(random.uniform(0, 0.05))),
-            'accrualDaily': spread * notional_amount / Decimal('365'),
-            'accrualProjected': spread * notional_amount * Decimal('150') / Decimal('365'),
-            'accrualPast': spread * notional_amount * Decimal('90') / Decimal('365'),
-            'calculatedAt': datetime.now(),
-            'ead': notional_amount * Decimal('0.4'),
-            'spread': spread
-        }
-        risk_data.append(risk_record)
-    
-    return risk_data
+    return generate_fo_risk_frame(trades, snapId, snapVersion).to_dicts()
+
 
 def insert_fo_risk_data(client, risk_data):
     df = pl.DataFrame(risk_data)
@@ -122,9 +285,18 @@ def insert_fo_risk_data(client, risk_data):
     print(columns)
     client.insert_df(Tables.RISK.value, pdf, column_names=columns)
 
+
+def insert_fo_risk_frame(client, risk: pl.DataFrame) -> None:
+    if risk.is_empty():
+        return
+    client.insert_arrow(Tables.RISK.value, risk.to_arrow())
+
+def latest_snap_version(client, snapId: str) -> Optional[int]:
+    return client.query(f"SELECT MAX(snapVersion) FROM {Tables.JOBS.value} WHERE snapId = '{snapId}'").result_rows[0][0]
+
 def create_job(client, snapId: str) -> Job:
     try:
-        latest_version = client.query(f"SELECT MAX(snapVersion) FROM {Tables.JOBS.value} WHERE snapId = '{snapId}'").result_rows[0][0]
+        latest_version = latest_snap_version(client, snapId)
         version = 0 if latest_version is None else latest_version + 1
     except Exception as e:
         print(f"Error querying version, defaulting to 0: {str(e)}")
@@ -139,21 +311,52 @@ def create_job(client, snapId: str) -> Job:
     return job
 
 def update_job_status(client, job: Job) -> None:
-    df = pl.DataFrame([job.to_dict()])
+    insert_jobs(client, [job])
+
+
+def insert_jobs(client, jobs: List[Job]) -> None:
+    df = pl.DataFrame([job.to_dict() for job in jobs])
     # Get columns directly from DataFrame schema
     columns = df.columns
     pdf = df.to_pandas()
     client.insert_df(Tables.JOBS.value, pdf, column_names=columns)
 
 
-def run_risk():
+def insert_tombstones(client, previous_ids, risk_ids, snapId: str, snapVersion: int,
+                      asOfDate: date, calculatedAt: datetime) -> int:
+    """Tombstone the trades of the previous version missing from this one, returns how many"""
+    removed = removed_ids(previous_ids, risk_ids)
+    insert_fo_risk_frame(client, tombstone_frame(removed, snapId, snapVersion, asOfDate, calculatedAt))
+    return len(removed)
+
+
+def run_risk(delta: bool = False, day_count: Optional[str] = None):
+    """Publish the next intraday version; with delta only rows that changed since the previous version are written"""
     store = Store()
     snapId = 'LIVE'+datetime.now().strftime("%Y%m%d")
     job = create_job(store.client,snapId)
         # Generate and insert risk data
-    risk_data = generate_fo_risk_data(store.client, job.snapId, job.snapVersion)
-    insert_fo_risk_data(store.client, risk_data)
-    print(f"Inserted {len(risk_data)} risk records", datetime.now())
+    calculatedAt = datetime.now()
+    trades = fetch_trades(store.client)
+    # Every version of the snapshot prices off the matrix its first version published
+    fx = FxRateMatrix.for_snapshot(snapId, trades['currency'].unique().to_list() + [FUNDING_CCY],
+                                   seed=snapshot_seed(snapId))
+    risk = generate_fo_risk_frame(trades, job.snapId, job.snapVersion, calculatedAt=calculatedAt,
+                                  day_count=day_count, fx=fx)
+    total = risk.height
+    cache = FingerprintCache()
+    previous = cache.load(job.snapId, job.snapVersion - 1)
+    if delta:
+        risk, fingerprints = delta_risk_frame(risk, previous)
+    else:
+        fingerprints = risk_fingerprints(risk)
+    # Without cached fingerprints the previous version's trades come from risk_f
+    previous_ids = previous['id'] if previous is not None else live_ids(store.client, job.snapId, job.snapVersion - 1)
+    insert_fo_risk_frame(store.client, risk)
+    removed = insert_tombstones(store.client, previous_ids, fingerprints['id'], job.snapId, job.snapVersion,
+                                calculatedAt.date(), calculatedAt)
+    cache.save(job.snapId, job.snapVersion, fingerprints)
+    print(f"Inserted {risk.height} of {total} risk records, {removed} removed", datetime.now())
     job.complete()
     update_job_status(store.client, job)
     print(f"Completed job {job.id}", datetime.now())
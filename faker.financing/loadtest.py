@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+from marketsim import SimulatorConfig
+from metrics import Histogram
+from pricingservice import BATCH_SECONDS, InstrumentPricingService, PricingConfig
+
+
+@dataclass
+class LoadTestPlan:
+    sizes: List[int] = field(default_factory=lambda: [1_000, 10_000, 100_000, 1_000_000])
+    batch_sizes: List[int] = field(default_factory=lambda: [100, 1_000])
+    pool_sizes: List[int] = field(default_factory=lambda: [10, 100])
+    concurrency: List[Optional[int]] = field(default_factory=lambda: [None])  # None = pool size
+    backend: str = 'memory'     # 'redis' needs a server at redis_host:redis_port
+    redis_host: str = 'localhost'
+    redis_port: int = 6379
+    storage: str = 'hash'
+    simulated: bool = True      # MarketSimulator pricing, False uses the per-instrument mock
+    warmup_cycles: int = 1      # first cycles write every instrument, they are not measured
+    cycles: int = 30            # measured cycles, rates are over the time spent pricing only
+    update_interval: float = 1.0  # cycles start this many seconds apart, a case keeps up if every cycle fits in it
+    output: str = 'loadtest_report.json'
+
+
+@dataclass
+class LoadTestResult:
+    instruments: int
+    batch_size: int
+    pool_size: int
+    max_concurrency: Optional[int]
+    cycles: int
+    updates_per_second: float
+    instruments_per_second: float
+    cycle_p50_ms: float
+    cycle_max_ms: float
+    # per batch, from the BATCH_SECONDS histogram: cycles are too few for a meaningful p99
+    batch_p50_ms: float
+    batch_p99_ms: float
+    redis_ops_per_second: Optional[float]
+    cpu_percent: float
+    failed_batches: int
+    timed_out_batches: int
+    keeps_up: bool  # the slowest measured cycle fits in update_interval
+
+
+async def _commands_processed(service: InstrumentPricingService) -> Optional[int]:
+    info = await service.redis_client.info('stats')
+    return info.get('total_commands_processed')
+
+
+def _window(histogram: Histogram, counts: List[int]) -> Histogram:
+    """Values recorded in histogram since its counts were copied to counts"""
+    window = Histogram(histogram.name, histogram.help, histogram.unit)
+    window.counts = [after - before for after, before in zip(histogram.counts, counts)]
+    window.count = sum(window.counts)
+    # the window's largest value is unknown, quantiles are their bucket's upper bound
+    window.max = float('inf')
+    return window
+
+
+async def run_case(plan: LoadTestPlan, instruments: int, batch_size: int, pool_size: int,
+                   max_concurrency: Optional[int]) -> LoadTestResult:
+    config = PricingConfig(
+        redis_host=plan.redis_host, redis_port=plan.redis_port, pool_size=pool_size,
+        batch_size=batch_size, max_concurrency=max_concurrency, storage=plan.storage, backend=plan.backend,
+        simulator=SimulatorConfig(seed=1) if plan.simulated else None, stream_key=None,
+    )
+    service = InstrumentPricingService(config)
+    await service.connect_redis(clear=True)
+    instrument_ids = [f'INST_{i}' for i in range(instruments)]
+    try:
+        for _ in range(plan.warmup_cycles):
+            await service.update_all_instrument_prices(instrument_ids)
+
+        latencies, updated, failed, timed_out = [], 0, 0, 0
+        busy = cpu = 0.0
+        ops = 0
+        batch_counts = list(BATCH_SECONDS.counts)
+        deadline = time.monotonic()
+        for _ in range(plan.cycles):
+            # Fixed-rate cycles so the simulator moves as many quotes as it would in production
+            deadline += plan.update_interval
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+            ops_before = await _commands_processed(service)
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            stats = await service.update_all_instrument_prices(instrument_ids)
+            busy += time.perf_counter() - wall_start
+            cpu += time.process_time() - cpu_start
+            ops_after = await _commands_processed(service)
+            # a backend that stops reporting leaves the rate unknown rather than partial
+            if ops is not None and ops_before is not None and ops_after is not None:
+                ops += ops_after - ops_before
+            else:
+                ops = None
+            latencies.append(stats.elapsed)
+            updated += stats.updated
+            failed += stats.failed
+            timed_out += stats.timed_out
+    finally:
+        await service.clear_prices()
+        await service.close_redis()
+
+    latencies_ms = np.array(latencies) * 1000
+    batches = _window(BATCH_SECONDS, batch_counts)
+    priced = instruments * plan.cycles
+    return LoadTestResult(
+        instruments=instruments,
+        batch_size=batch_size,
+        pool_size=pool_size,
+        max_concurrency=max_concurrency,
+        cycles=plan.cycles,
+        updates_per_second=updated / busy,
+        instruments_per_second=priced / busy,
+        cycle_p50_ms=float(np.percentile(latencies_ms, 50)),
+        cycle_max_ms=float(latencies_ms.max()),
+        batch_p50_ms=batches.quantile(0.5) * 1000,
+        batch_p99_ms=batches.quantile(0.99) * 1000,
+        # includes one INFO call per cycle, negligible against a cycle's commands
+        redis_ops_per_second=ops / busy if ops is not None else None,
+        cpu_percent=100 * cpu / busy,
+        failed_batches=failed,
+        timed_out_batches=timed_out,
+        keeps_up=float(latencies_ms.max()) <= plan.update_interval * 1000,
+    )
+
+
+def _environment() -> Dict[str, object]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+    }
+
+
+async def run_load_test(plan: Optional[LoadTestPlan] = None) -> Dict[str, object]:
+    """Run every size x batch_size x pool_size x concurrency case and write the JSON report"""
+    plan = plan or LoadTestPlan()
+    results = []
+    for instruments, batch_size, pool_size, max_concurrency in itertools.product(
+            plan.sizes, plan.batch_sizes, plan.pool_sizes, plan.concurrency):
+        result = await run_case(plan, instruments, batch_size, pool_size, max_concurrency)
+        print(f"{instruments:>9,} instruments, batch {batch_size:>5}, pool {pool_size:>4}: "
+              f"{result.instruments_per_second:>12,.0f} instruments/s, cycle p50 {result.cycle_p50_ms:.1f}ms "
+              f"max {result.cycle_max_ms:.1f}ms, batch p99 {result.batch_p99_ms:.2f}ms, cpu {result.cpu_percent:.0f}%")
+        results.append(asdict(result))
+
+    report = {
+        'createdAt': datetime.now().isoformat(),
+        'plan': asdict(plan),
+        'environment': _environment(),
+        'results': results,
+    }
+    with open(plan.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {plan.output}")
+    return report
+
+
+if __name__ == '__main__':
+    asyncio.run(run_load_test())
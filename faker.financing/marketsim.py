@@ -0,0 +1,304 @@
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import polars as pl
+
+# Trading seconds in a year, volatilities are annualised against this clock
+SECONDS_PER_YEAR = 252 * 6.5 * 3600
+
+
+@dataclass
+class SimulatorConfig:
+    model: str = 'gbm'            # 'gbm' or 'ou' (mean-reverting log price)
+    volatility: float = 0.2       # annualised
+    drift: float = 0.0            # annualised, gbm only
+    mean_reversion: float = 50.0  # ou speed per year towards the initial price
+    tick_size: float = 0.01
+    tick_threshold: int = 1       # ticks a quote must move before it is emitted
+    min_spread: float = 0.01
+    max_spread: float = 0.05
+    seed: Optional[int] = None
+
+
+@dataclass
+class FactorConfig:
+    # loadings on each factor, the idiosyncratic loading makes the variance one
+    market: float = 0.4
+    sector: float = 0.4
+    region: float = 0.3
+    currency: float = 0.2
+
+
+class FactorModel:
+    """Correlated standard normal shocks from a market + sector + region + currency factor model.
+
+    Each instrument's shock is the weighted sum of the common market factor,
+    its sector, region and currency factors, and its own noise, so two
+    instruments correlate by the squared loadings of the factors they share.
+    Drawing costs O(instruments + factors) per step, with no n x n matrix.
+    """
+
+    def __init__(self, sector: Sequence[str], region: Sequence[str], currency: Sequence[str],
+                 config: Optional[FactorConfig] = None, seed=None):
+        self.config = config or FactorConfig()
+        c = self.config
+        systematic = c.market ** 2 + c.sector ** 2 + c.region ** 2 + c.currency ** 2
+        if systematic >= 1:
+            raise ValueError(f"Factor loadings explain {systematic:.2f} of the variance, must be below 1")
+        self.idiosyncratic = np.sqrt(1 - systematic)
+        self.rng = np.random.default_rng(seed)
+        self.groups: Dict[str, Dict[str, int]] = {'sector': {}, 'region': {}, 'currency': {}}
+        self.codes = {name: np.empty(0, dtype=np.int64) for name in self.groups}
+        self.add_instruments(sector, region, currency)
+
+    def __len__(self) -> int:
+        return len(self.codes['sector'])
+
+    def add_instruments(self, sector: Sequence[str], region: Sequence[str], currency: Sequence[str]) -> None:
+        for name, values in (('sector', sector), ('region', region), ('currency', currency)):
+            group = self.groups[name]
+            codes = np.fromiter((group.setdefault(v, len(group)) for v in values), dtype=np.int64, count=len(values))
+            self.codes[name] = np.concatenate([self.codes[name], codes])
+
+    def draw(self, n_steps: int = 1, idx: Optional[np.ndarray] = None) -> np.ndarray:
+        """(n_steps, instruments) correlated shocks for all instruments or idx"""
+        idx = np.arange(len(self)) if idx is None else idx
+        c = self.config
+        shocks = c.market * self.rng.standard_normal((n_steps, 1))
+        for name, loading in (('sector', c.sector), ('region', c.region), ('currency', c.currency)):
+            factors = self.rng.standard_normal((n_steps, len(self.groups[name])))
+            shocks = shocks + loading * factors[:, self.codes[name][idx]]
+        return shocks + self.idiosyncratic * self.rng.standard_normal((n_steps, len(idx)))
+
+    def correlation(self, i: int, j: int) -> float:
+        """Model correlation between the shocks of instruments i and j"""
+        if i == j:
+            return 1.0
+        c = self.config
+        return float(c.market ** 2
+                     + c.sector ** 2 * (self.codes['sector'][i] == self.codes['sector'][j])
+                     + c.region ** 2 * (self.codes['region'][i] == self.codes['region'][j])
+                     + c.currency ** 2 * (self.codes['currency'][i] == self.codes['currency'][j]))
+
+    def paths(self, initial_prices: np.ndarray, n_steps: int, dt_seconds: float,
+              volatility: float = 0.2) -> np.ndarray:
+        """(n_steps + 1, instruments) correlated GBM price paths starting at initial_prices"""
+        dt = dt_seconds / SECONDS_PER_YEAR
+        log_returns = -0.5 * volatility ** 2 * dt + volatility * np.sqrt(dt) * self.draw(n_steps)
+        log_paths = np.vstack([np.zeros((1, len(self))), np.cumsum(log_returns, axis=0)])
+        return np.asarray(initial_prices)[None, :] * np.exp(log_paths)
+
+
+def load_instrument_universe(client, since: Optional[datetime] = None) -> pl.DataFrame:
+    """Latest version of every ref_instruments row (updated at or after since) in one Arrow query.
+
+    The table keeps one row per (id, updatedAt), so versions are collapsed
+    with LIMIT 1 BY rather than FINAL.
+    """
+    query = f"""
+    SELECT id, isin, sector, region, currency, rating,
+           toFloat64(price) AS price, toFloat64(coupon) AS coupon, toFloat64(yieldToMaturity) AS yieldToMaturity,
+           maturityDate, updatedAt
+    FROM ref_instruments
+    {"WHERE updatedAt >= {since:DateTime}" if since is not None else ""}
+    ORDER BY id, updatedAt DESC
+    LIMIT 1 BY id
+    """
+    universe = pl.from_arrow(client.query_arrow(query, parameters={'since': since} if since is not None else None))
+    return universe.with_columns(pl.col('id', 'isin', 'sector', 'region', 'currency', 'rating').cast(pl.Utf8))
+
+
+def correlated_simulator(universe: pl.DataFrame, config: Optional['SimulatorConfig'] = None,
+                         factors: Optional[FactorConfig] = None) -> 'MarketSimulator':
+    """MarketSimulator over a universe frame (see load_instrument_universe) with factor-model shocks"""
+    config = config or SimulatorConfig()
+    shocks = FactorModel(universe['sector'].to_list(), universe['region'].to_list(),
+                         universe['currency'].to_list(), factors, seed=config.seed)
+    return MarketSimulator(universe['id'].to_list(), universe['price'].to_numpy(), config, shocks)
+
+
+class MarketSimulator:
+    """Per-instrument market state held in NumPy arrays and advanced in one vectorised step.
+
+    The continuous price follows the configured model; the published quote
+    (``last``) only changes when the price has moved at least tick_threshold
+    ticks away from it, which is what ``step`` reports. Newly added
+    instruments are reported on their first step. Shocks are independent
+    unless a FactorModel aligned with the instruments is given.
+    """
+
+    def __init__(self, instrument_ids: Sequence[str], initial_prices: Optional[np.ndarray] = None,
+                 config: Optional[SimulatorConfig] = None, shocks: Optional[FactorModel] = None):
+        self.config = config or SimulatorConfig()
+        self.shocks = shocks
+        if self.config.model not in ('gbm', 'ou'):
+            raise ValueError(f"Unknown simulator model {self.config.model}, expected 'gbm' or 'ou'")
+        self.rng = np.random.default_rng(self.config.seed)
+        self.instrument_ids: List[str] = []
+        self.index: Dict[str, int] = {}
+        self.anchor = np.empty(0)
+        self.log_price = np.empty(0)
+        self.last = np.empty(0)
+        self.yest = np.empty(0)
+        self.spread = np.empty(0)
+        self._unpublished = np.empty(0, dtype=bool)
+        self._stepped_at = np.empty(0)
+        self._append(instrument_ids, initial_prices)
+
+    def __len__(self) -> int:
+        return len(self.instrument_ids)
+
+    def _to_tick(self, values: np.ndarray) -> np.ndarray:
+        tick = self.config.tick_size
+        return np.round(np.round(values / tick) * tick, 10)
+
+    def _draw_spreads(self, n: int) -> np.ndarray:
+        spreads = self._to_tick(self.rng.uniform(self.config.min_spread, self.config.max_spread, n))
+        return np.maximum(spreads, self.config.tick_size)
+
+    def add_instruments(self, instrument_ids: Sequence[str], initial_prices: Optional[np.ndarray] = None,
+                        sector: Optional[Sequence[str]] = None, region: Optional[Sequence[str]] = None,
+                        currency: Optional[Sequence[str]] = None) -> np.ndarray:
+        """Append instruments to the state, returns their indices.
+
+        With a factor model, instruments without attributes share an UNKNOWN sector, region and currency.
+        """
+        if self.shocks is not None:
+            unknown = ['UNKNOWN'] * len(instrument_ids)
+            self.shocks.add_instruments(sector or unknown, region or unknown, currency or unknown)
+        return self._append(instrument_ids, initial_prices)
+
+    def _append(self, instrument_ids: Sequence[str], initial_prices: Optional[np.ndarray]) -> np.ndarray:
+        instrument_ids = list(instrument_ids)
+        n = len(instrument_ids)
+        if initial_prices is None:
+            initial_prices = self.rng.uniform(50, 200, n)
+        initial_prices = np.asarray(initial_prices, dtype=np.float64)
+
+        start = len(self.instrument_ids)
+        self.instrument_ids.extend(instrument_ids)
+        self.index.update({inst_id: start + i for i, inst_id in enumerate(instrument_ids)})
+        quote = self._to_tick(initial_prices)
+        self.anchor = np.concatenate([self.anchor, np.log(initial_prices)])
+        self.log_price = np.concatenate([self.log_price, np.log(initial_prices)])
+        self.last = np.concatenate([self.last, quote])
+        self.yest = np.concatenate([self.yest, quote])
+        self.spread = np.concatenate([self.spread, self._draw_spreads(n)])
+        self._unpublished = np.concatenate([self._unpublished, np.ones(n, dtype=bool)])
+        self._stepped_at = np.concatenate([self._stepped_at, np.full(n, time.monotonic())])
+        return np.arange(start, start + n)
+
+    def indices(self, instrument_ids: Sequence[str]) -> np.ndarray:
+        """Positions of instrument_ids in the state arrays, adding any that are unknown"""
+        unknown = [inst_id for inst_id in instrument_ids if inst_id not in self.index]
+        if unknown:
+            self.add_instruments(unknown)
+        return np.fromiter((self.index[inst_id] for inst_id in instrument_ids), dtype=np.int64,
+                           count=len(instrument_ids))
+
+    def _shocks(self, idx: np.ndarray) -> np.ndarray:
+        if self.shocks is not None:
+            return self.shocks.draw(1, idx)[0]
+        return self.rng.standard_normal(len(idx))
+
+    def step(self, idx: Optional[np.ndarray] = None, now: Optional[float] = None) -> np.ndarray:
+        """Advance instruments (all, or idx) to now and return the indices whose quote moved"""
+        now = time.monotonic() if now is None else now
+        idx = np.arange(len(self)) if idx is None else np.asarray(idx, dtype=np.int64)
+        dt = np.maximum(now - self._stepped_at[idx], 0.0) / SECONDS_PER_YEAR
+        self._stepped_at[idx] = now
+
+        sigma = self.config.volatility
+        diffusion = sigma * np.sqrt(dt) * self._shocks(idx)
+        x = self.log_price[idx]
+        if self.config.model == 'gbm':
+            x = x + (self.config.drift - 0.5 * sigma ** 2) * dt + diffusion
+        else:
+            x = x + self.config.mean_reversion * (self.anchor[idx] - x) * dt + diffusion
+        self.log_price[idx] = x
+
+        quote = self._to_tick(np.exp(x))
+        threshold = self.config.tick_threshold * self.config.tick_size
+        # instruments never reported yet are always emitted once
+        moved_mask = (np.abs(quote - self.last[idx]) >= threshold - 1e-9) | self._unpublished[idx]
+        moved = idx[moved_mask]
+        self.last[moved] = quote[moved_mask]
+        self.spread[moved] = self._draw_spreads(len(moved))
+        self._unpublished[moved] = False
+        return moved
+
+    def restore(self, instrument_ids: Sequence[str], last: np.ndarray, yest: np.ndarray, spread: np.ndarray,
+                log_price: Optional[np.ndarray] = None, anchor: Optional[np.ndarray] = None) -> np.ndarray:
+        """Resume from published quotes: instruments continue from last and are not re-emitted.
+
+        Unknown instruments are added at their last price. The continuous log
+        price and ou anchor default to the log of last when not saved.
+        """
+        last = np.asarray(last, dtype=np.float64)
+        unknown = np.fromiter((inst_id not in self.index for inst_id in instrument_ids), dtype=bool,
+                              count=len(instrument_ids))
+        if unknown.any():
+            self.add_instruments([inst_id for inst_id, u in zip(instrument_ids, unknown) if u], last[unknown])
+        idx = self.indices(instrument_ids)
+        self.last[idx] = last
+        self.yest[idx] = yest
+        self.spread[idx] = spread
+        self.log_price[idx] = np.log(last) if log_price is None else log_price
+        if anchor is not None:
+            self.anchor[idx] = anchor
+        self._unpublished[idx] = False
+        self._stepped_at[idx] = time.monotonic()
+        return idx
+
+    def reprice(self, instrument_ids: Sequence[str], prices: np.ndarray) -> np.ndarray:
+        """Move instruments to new reference prices: last, the log price and the ou anchor jump there.
+
+        yest and spread are kept; the instruments are emitted on their next step.
+        """
+        prices = np.asarray(prices, dtype=np.float64)
+        idx = self.indices(instrument_ids)
+        self.last[idx] = self._to_tick(prices)
+        self.log_price[idx] = self.anchor[idx] = np.log(prices)
+        self._unpublished[idx] = True
+        return idx
+
+    def mark_unpublished(self, instrument_ids: Sequence[str], flags=True) -> None:
+        """Set whether instruments are emitted on their next step regardless of movement (flags: bool or per id)"""
+        self._unpublished[self.indices(instrument_ids)] = flags
+
+    def save(self, path: str, **extra) -> None:
+        """Snapshot the state arrays (and any extra scalars) to an .npz file"""
+        np.savez(path, instrument_ids=np.array(self.instrument_ids), anchor=self.anchor, log_price=self.log_price,
+                 last=self.last, yest=self.yest, spread=self.spread, **extra)
+
+    def load(self, path: str, instrument_ids: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """Restore a snapshot written by save, only instrument_ids when given; returns the restored arrays"""
+        with np.load(path) as snapshot:
+            state = dict(snapshot)
+        if instrument_ids is not None:
+            wanted = set(instrument_ids)
+            keep = np.array([i in wanted for i in state['instrument_ids'].tolist()], dtype=bool)
+            for name in ('instrument_ids', 'anchor', 'log_price', 'last', 'yest', 'spread'):
+                state[name] = state[name][keep]
+        self.restore(state['instrument_ids'].tolist(), state['last'], state['yest'], state['spread'],
+                     state['log_price'], state['anchor'])
+        return state
+
+    def roll_day(self) -> None:
+        """Start a new session: today's last quotes become yesterday's close"""
+        self.yest = self.last.copy()
+
+    def quotes(self, idx: np.ndarray) -> Dict[str, np.ndarray]:
+        """last/bid/ask/spread/yest arrays for idx"""
+        last = self.last[idx]
+        spread = self.spread[idx]
+        return {
+            'last': last,
+            'bid': np.round(last - spread / 2, 2),
+            'ask': np.round(last + spread / 2, 2),
+            'spread': spread,
+            'yest': self.yest[idx],
+        }
@@ -0,0 +1,155 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis # type: ignore
+from pricingservice import InstrumentPricingService, PriceRecord
+
+INVALIDATE_CHANNEL = '__redis__:invalidate'
+
+
+class PriceCache:
+    """In-process LRU of decoded prices kept consistent by Redis client-side tracking.
+
+    A dedicated connection turns on broadcast tracking for the service's
+    price key prefix and redirects invalidations to a pub/sub connection, so
+    every rewrite of a cached price by the pricing service evicts it here.
+    Reads of cached instruments are dictionary lookups; misses are fetched
+    through the service in one round trip. While the invalidation link is
+    down the cache is emptied and bypassed rather than served stale.
+    """
+
+    def __init__(self, service: InstrumentPricingService, max_size: int = 100_000):
+        self.service = service
+        self.max_size = max_size
+        self._prices: 'OrderedDict[str, PriceRecord]' = OrderedDict()
+        # instrument ids being fetched -> invalidated while in flight
+        self._in_flight: Dict[str, bool] = {}
+        self._tracker: Optional[redis.Redis] = None
+        self._listener: Optional[redis.Redis] = None
+        self._pubsub = None
+        self._task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def start(self) -> None:
+        if not self.service.redis_client:
+            await self.service.connect_redis()
+        self._task = asyncio.create_task(self._listen())
+        ready = asyncio.create_task(self._ready.wait())
+        await asyncio.wait({ready, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            # the listener died before the first connection, surface its error instead of waiting forever
+            ready.cancel()
+            task, self._task = self._task, None
+            task.result()
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._disconnect()
+
+    async def _connect(self):
+        config = self.service.config
+        name = f'price-cache-{uuid.uuid4().hex[:12]}'
+        self._listener = redis.Redis(host=config.redis_host, port=config.redis_port, client_name=name)
+        pubsub = self._pubsub = self._listener.pubsub()
+        await pubsub.subscribe(INVALIDATE_CHANNEL)
+        # Tracking is per connection, so it lives on one that is never returned to a pool
+        self._tracker = redis.Redis(host=config.redis_host, port=config.redis_port, single_connection_client=True)
+        listener_id = next(int(c['id']) for c in await self._tracker.client_list(_type='pubsub') if c['name'] == name)
+        await self._tracker.client_tracking_on(clientid=listener_id, prefix=[self.service.PRICE_PREFIX], bcast=True)
+        return pubsub
+
+    async def _disconnect(self) -> None:
+        self._ready.clear()
+        self._prices.clear()
+        for client in (self._pubsub, self._tracker, self._listener):
+            if client:
+                await client.aclose()
+        self._pubsub = self._tracker = self._listener = None
+
+    async def _listen(self) -> None:
+        try:
+            while True:
+                try:
+                    pubsub = await self._connect()
+                    self._ready.set()
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self._invalidate(message['data'])
+                except (redis.ConnectionError, redis.TimeoutError) as e:
+                    print(f"Price cache invalidation link lost, cache disabled until reconnected: {e}")
+                    await self._disconnect()
+                    await asyncio.sleep(1)
+        finally:
+            # any other exit (an unexpected error or stop) leaves the cache disabled and its connections closed
+            await self._disconnect()
+
+    def _invalidate(self, keys: Optional[List[bytes]]) -> None:
+        # None means the server flushed the database
+        if keys is None:
+            self._prices.clear()
+            for inst_id in self._in_flight:
+                self._in_flight[inst_id] = True
+            return
+        prefix = len(self.service.PRICE_PREFIX)
+        for key in keys:
+            inst_id = key.decode()[prefix:]
+            self.invalidations += self._prices.pop(inst_id, None) is not None
+            if inst_id in self._in_flight:
+                self._in_flight[inst_id] = True
+
+    def get_cached(self, instrument_id: str) -> Optional[PriceRecord]:
+        """Cached price without touching Redis, None when it is not cached"""
+        record = self._prices.get(instrument_id)
+        if record is not None:
+            self._prices.move_to_end(instrument_id)
+        return record
+
+    async def get(self, instrument_id: str) -> Optional[PriceRecord]:
+        return (await self.get_many([instrument_id])).get(instrument_id)
+
+    async def get_many(self, instrument_ids: List[str]) -> Dict[str, PriceRecord]:
+        """Prices of instrument_ids, fetching the uncached ones in one round trip"""
+        prices = {}
+        missing = []
+        for inst_id in instrument_ids:
+            record = self.get_cached(inst_id) if self._ready.is_set() else None
+            if record is None:
+                missing.append(inst_id)
+            else:
+                prices[inst_id] = record
+        self.hits += len(prices)
+        self.misses += len(missing)
+        if not missing:
+            return prices
+
+        # A rewrite that lands while the fetch is in flight may be older than its invalidation
+        fetching = [inst_id for inst_id in missing if inst_id not in self._in_flight]
+        self._in_flight.update(dict.fromkeys(fetching, False))
+        try:
+            records = await self.service.fetch_prices(missing)
+        finally:
+            invalidated = {inst_id for inst_id in fetching if self._in_flight.pop(inst_id)}
+        for record in records:
+            prices[record.instrument_id] = record
+            if self._ready.is_set() and record.instrument_id in fetching and record.instrument_id not in invalidated:
+                self._store(record)
+        return prices
+
+    def _store(self, record: PriceRecord) -> None:
+        self._prices[record.instrument_id] = record
+        self._prices.move_to_end(record.instrument_id)
+        while len(self._prices) > self.max_size:
+            self._prices.popitem(last=False)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
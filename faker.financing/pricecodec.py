@@ -0,0 +1,60 @@
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+PRICE_FIELDS = ['last', 'bid', 'ask', 'spread', 'yest']
+# Fixed-width little-endian record per instrument: five float64 prices and an epoch-nanosecond timestamp
+PACKED_DTYPE = np.dtype([(field, '<f8') for field in PRICE_FIELDS] + [('ts', '<i8')])
+RECORD_SIZE = PACKED_DTYPE.itemsize
+# Pub/sub message: record count, the records, then the newline separated ids
+MESSAGE_HEADER = struct.Struct('<I')
+
+
+def pack_quotes(quotes: Dict[str, Sequence[float]], ts_ns) -> np.ndarray:
+    """Structured array of records from per-field price columns and a timestamp (scalar or column)"""
+    records = np.empty(len(quotes['last']), dtype=PACKED_DTYPE)
+    for field in PRICE_FIELDS:
+        records[field] = quotes[field]
+    records['ts'] = ts_ns
+    return records
+
+
+def encode_records(records: np.ndarray) -> List[bytes]:
+    """One RECORD_SIZE-byte value per record"""
+    buffer = records.tobytes()
+    return [buffer[i:i + RECORD_SIZE] for i in range(0, len(buffer), RECORD_SIZE)]
+
+
+def decode_records(values: Sequence[Optional[bytes]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Records decoded from values and a mask of which values were present; missing records are zeroed"""
+    present = np.fromiter((v is not None for v in values), dtype=bool, count=len(values))
+    records = np.zeros(len(values), dtype=PACKED_DTYPE)
+    if present.any():
+        records[present] = np.frombuffer(b''.join(v for v in values if v is not None), dtype=PACKED_DTYPE)
+    return records, present
+
+
+def encode_batch(instrument_ids: Sequence[str], records: np.ndarray) -> Dict[str, bytes]:
+    """Stream entry fields for a batch: newline separated ids and their concatenated records"""
+    return {'ids': '\n'.join(instrument_ids).encode(), 'prices': records.tobytes()}
+
+
+def decode_batch(fields: Dict[bytes, bytes]) -> Tuple[List[str], np.ndarray]:
+    """Inverse of encode_batch"""
+    ids = fields[b'ids'].decode().split('\n') if fields[b'ids'] else []
+    return ids, np.frombuffer(fields[b'prices'], dtype=PACKED_DTYPE)
+
+
+def encode_message(instrument_ids: Sequence[str], records: np.ndarray) -> bytes:
+    """One pub/sub payload for a batch, see MESSAGE_HEADER"""
+    return MESSAGE_HEADER.pack(len(records)) + records.tobytes() + '\n'.join(instrument_ids).encode()
+
+
+def decode_message(payload: bytes) -> Tuple[List[str], np.ndarray]:
+    """Inverse of encode_message, the records are a read-only view of payload"""
+    count, = MESSAGE_HEADER.unpack_from(payload)
+    end = MESSAGE_HEADER.size + count * RECORD_SIZE
+    records = np.frombuffer(payload, dtype=PACKED_DTYPE, count=count, offset=MESSAGE_HEADER.size)
+    ids = payload[end:].decode().split('\n') if count else []
+    return ids, records
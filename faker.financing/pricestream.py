@@ -0,0 +1,115 @@
+import asyncio
+import os
+import socket
+import time
+from typing import AsyncIterator, List, Tuple
+
+import redis.asyncio as redis # type: ignore
+from backends import make_async_client
+from pricecodec import decode_batch
+from pricingservice import PriceRecord
+
+STREAM_KEY = 'prices:changes'
+
+
+class PriceStreamConsumer:
+    """Reads the price-change stream written by InstrumentPricingService through a consumer group.
+
+    Every consumer in a group receives a disjoint share of the batch entries,
+    so readers scale horizontally by starting more consumers with distinct
+    names. Entries stay pending until acknowledged: a consumer restarted
+    under the same (stable) name first re-reads its own pending entries, and
+    iterating claims entries a dead consumer left idle for claim_idle_ms, on
+    start and then every claim_interval seconds.
+    """
+
+    def __init__(self, client: redis.Redis, group: str, consumer: str,
+                 stream_key: str = STREAM_KEY, count: int = 100, block_ms: int = 1000,
+                 claim_idle_ms: int = 60_000, claim_interval: float = 30.0):
+        if not consumer:
+            raise ValueError("A stable consumer name is required to recover pending entries after a restart")
+        self.client = client
+        self.group = group
+        self.consumer = consumer
+        self.stream_key = stream_key
+        self.count = count
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.claim_interval = claim_interval
+        # '0' replays this consumer's pending entries, '>' asks for new ones
+        self._read_id = '0'
+
+    async def ensure_group(self, start_id: str = '$') -> None:
+        """Create the group (and the stream) if needed, new groups start at start_id ('$' = only new entries)"""
+        try:
+            await self.client.xgroup_create(self.stream_key, self.group, id=start_id, mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def read(self) -> List[Tuple[bytes, List[PriceRecord]]]:
+        """Next entries for this consumer as (entry id, records), empty if none arrived within block_ms"""
+        response = await self.client.xreadgroup(
+            self.group, self.consumer, {self.stream_key: self._read_id},
+            count=self.count, block=None if self._read_id == '0' else self.block_ms,
+        )
+        entries = response[0][1] if response else []
+        if self._read_id == '0' and len(entries) < self.count:
+            # the pending backlog is drained, switch to new entries
+            self._read_id = '>'
+        # entries trimmed from the stream while pending come back without fields
+        return [(entry_id, self.decode(fields)) for entry_id, fields in entries]
+
+    @staticmethod
+    def decode(fields) -> List[PriceRecord]:
+        if not fields:
+            return []
+        instrument_ids, records = decode_batch(fields)
+        return [PriceRecord.from_packed(inst_id, record) for inst_id, record in zip(instrument_ids, records)]
+
+    async def ack(self, entry_ids: List[bytes]) -> int:
+        if not entry_ids:
+            return 0
+        return await self.client.xack(self.stream_key, self.group, *entry_ids)
+
+    async def claim_stale(self, min_idle_ms: int = 60_000) -> List[Tuple[bytes, List[PriceRecord]]]:
+        """Take over entries left pending by other consumers for at least min_idle_ms"""
+        claimed = []
+        start_id = '0-0'
+        while True:
+            response = await self.client.xautoclaim(self.stream_key, self.group, self.consumer,
+                                                    min_idle_ms, start_id, count=self.count)
+            start_id, entries = response[0], response[1]
+            claimed.extend((entry_id, self.decode(fields)) for entry_id, fields in entries)
+            if start_id in (b'0-0', '0-0'):
+                return claimed
+
+    async def __aiter__(self) -> AsyncIterator[List[PriceRecord]]:
+        """Batches of changed prices, each acknowledged once the consumer asks for the next one"""
+        await self.ensure_group()
+        next_claim = time.monotonic()
+        while True:
+            if time.monotonic() >= next_claim:
+                entries = await self.claim_stale(self.claim_idle_ms)
+                next_claim = time.monotonic() + self.claim_interval
+            else:
+                entries = await self.read()
+            for entry_id, records in entries:
+                yield records
+                await self.ack([entry_id])
+
+
+async def main() -> None:
+    client = make_async_client('redis', 'localhost', 6379)
+    # The name must survive restarts, the host name by default, PRICE_CONSUMER when several run on a host
+    consumer = PriceStreamConsumer(client, group='price-readers',
+                                   consumer=os.getenv('PRICE_CONSUMER', socket.gethostname()))
+    try:
+        async for records in consumer:
+            print(f"{consumer.consumer} received {len(records)} changed prices")
+    finally:
+        await client.aclose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,10 +1,26 @@
 import asyncio
+import os
 import random
 import time
 from dataclasses import dataclass
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Callable, List, Dict, Optional, Tuple
+import numpy as np
+import pyarrow as pa
 import redis.asyncio as redis # type: ignore
-from datetime import datetime
+from datetime import date, datetime
+from backends import BACKENDS, make_async_client
+from marketsim import MarketSimulator, SimulatorConfig
+from metrics import REGISTRY
+from pricecodec import PRICE_FIELDS, decode_records, encode_batch, encode_records, pack_quotes
+
+BATCH_SECONDS = REGISTRY.histogram('pricing_batch_seconds', 'Time to price and write one batch')
+REDIS_SECONDS = REGISTRY.histogram('pricing_redis_roundtrip_seconds', 'One pipelined Redis round trip')
+BATCHES_WAITING = REGISTRY.histogram('pricing_batches_waiting', 'Batches queued behind the concurrency limit when a batch starts', unit=1)
+UPDATES = REGISTRY.counter('pricing_updates_total', 'Prices written')
+SKIPS = REGISTRY.counter('pricing_skips_total', 'Instruments priced with no change to write')
+ERRORS = REGISTRY.counter('pricing_errors_total', 'Batches that failed')
+TIMEOUTS = REGISTRY.counter('pricing_timeouts_total', 'Batches cancelled after batch_timeout')
+
 
 @dataclass
 class PricingConfig:
@@ -15,25 +31,260 @@ class PricingConfig:
     batch_size: int = 100
     update_interval: int = 1
     retry_attempts: int = 3
+    max_concurrency: Optional[int] = None  # batches in flight, defaults to pool_size
+    batch_timeout: Optional[float] = None  # seconds before a batch is cancelled
+    simulator: Optional[SimulatorConfig] = None  # price from a stateful MarketSimulator instead of the mock
+    storage: str = 'hash'  # 'hash' of text fields per instrument, or 'packed' 48-byte binary record
+    stream_key: Optional[str] = 'prices:changes'  # stream of changed prices per batch, None to disable
+    stream_maxlen: int = 100_000  # approximate number of batch entries kept in the stream
+    snapshot_path: Optional[str] = None  # .npz simulator snapshot for warm starts, Redis is used without one
+    backend: str = 'redis'  # 'redis', or 'memory' for an in-process keyspace (benchmarks without a server)
+    shard: Optional[str] = None  # shard name when several services share a node, suffixes the sequence and session keys
+
+
+@dataclass
+class PriceRecord:
+    instrument_id: str
+    last: float
+    bid: float
+    ask: float
+    spread: float
+    yest: float
+    timestamp: datetime
+
+    @classmethod
+    def from_hash(cls, instrument_id: str, fields: Dict[bytes, bytes]) -> 'PriceRecord':
+        return cls(
+            instrument_id=instrument_id,
+            last=float(fields[b'last']),
+            bid=float(fields[b'bid']),
+            ask=float(fields[b'ask']),
+            spread=float(fields[b'spread']),
+            yest=float(fields[b'yest']),
+            timestamp=datetime.fromisoformat(fields[b'timestamp'].decode()),
+        )
+
+    @classmethod
+    def from_packed(cls, instrument_id: str, record: np.void) -> 'PriceRecord':
+        return cls(
+            instrument_id=instrument_id,
+            last=float(record['last']),
+            bid=float(record['bid']),
+            ask=float(record['ask']),
+            spread=float(record['spread']),
+            yest=float(record['yest']),
+            timestamp=datetime.fromtimestamp(int(record['ts']) / 1e9),
+        )
+
+
+PRICE_SCHEMA = pa.schema([
+    ('instrument_id', pa.string()),
+    ('last', pa.float64()),
+    ('bid', pa.float64()),
+    ('ask', pa.float64()),
+    ('spread', pa.float64()),
+    ('yest', pa.float64()),
+    ('timestamp', pa.timestamp('us')),
+])
+
+
+@dataclass
+class CycleStats:
+    instruments: int
+    batches: int
+    updated: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Instruments priced per second"""
+        return self.instruments / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.instruments} instruments in {self.batches} batches, {self.updated} updated, "
+                f"{self.failed} failed, {self.timed_out} timed out in {self.elapsed:.2f}s "
+                f"({self.throughput:,.0f} instruments/s)")
 
 class InstrumentPricingService:
-    def __init__(self, config: Optional[PricingConfig] = None):
+    def __init__(self, config: Optional[PricingConfig] = None, simulator: Optional[MarketSimulator] = None):
         self.config = config or PricingConfig()
-        self.redis_pool = redis.ConnectionPool(
+        if self.config.backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {self.config.backend}, expected one of {BACKENDS}")
+        # Blocking pool: batches beyond pool_size wait up to pool_timeout for a connection
+        self.redis_pool = redis.BlockingConnectionPool(
             host=self.config.redis_host,
             port=self.config.redis_port,
-            max_connections=self.config.pool_size
-        )
+            max_connections=self.config.pool_size,
+            timeout=self.config.pool_timeout
+        ) if self.config.backend == 'redis' else None
         self.redis_client: Optional[redis.Redis] = None
-        self.PRICE_PREFIX = 'price:'
+        if self.config.storage not in ('hash', 'packed'):
+            raise ValueError(f"Unknown storage {self.config.storage}, expected 'hash' or 'packed'")
+        self.packed = self.config.storage == 'packed'
+        # Separate prefixes so the two layouts never collide on key type
+        self.PRICE_PREFIX = 'pricebin:' if self.packed else 'price:'
+        # Set of every priced instrument id, lets readers walk the board without scanning the keyspace
+        self.REGISTRY_KEY = 'instruments:priced'
+        # Incremented once per pricing cycle, survives restarts with the prices
+        # Shards sharing a node each keep their own sequence and session; prices, the registry
+        # and the change stream are shared, stream entries carry the shard their seq belongs to
+        suffix = f':{self.config.shard}' if self.config.shard else ''
+        self.SEQ_KEY = f'pricing:seq{suffix}'
+        self.sequence = 0
+        # Date of the session the published yest closes, a later date rolls the board into a new session
+        self.SESSION_KEY = f'pricing:session{suffix}'
+        self.session: Optional[date] = None
+        # A prebuilt simulator (e.g. marketsim.correlated_simulator) is used as is
+        self.simulator = simulator
+        self._registered: set = set()
+        # Called with (instrument_ids, packed records) after every batch write, e.g. a ticksink.TickSink
+        self.listeners: List[Callable[[List[str], np.ndarray], None]] = []
 
-    async def connect_redis(self) -> None:
+    async def connect_redis(self, clear: bool = False) -> None:
+        """Connect keeping existing prices, clear=True drops this service's keys first"""
         # retry = Retry(ExponentialBackoff(), self.config.retry_attempts)
-        self.redis_client = redis.Redis(
-            connection_pool=self.redis_pool,
-           
+        self.redis_client = make_async_client(
+            self.config.backend,
+            self.config.redis_host,
+            self.config.redis_port,
+            connection_pool=self.redis_pool
         )
-        await self.redis_client.flushdb(asynchronous=True)
+        if clear:
+            await self.clear_prices()
+
+    async def clear_prices(self, chunk_size: int = 1000) -> int:
+        """Unlink every key of this service's layout, leaving the rest of the database alone"""
+        cleared = 0
+        keys = []
+        async for key in self.redis_client.scan_iter(match=f'{self.PRICE_PREFIX}*', count=chunk_size):
+            keys.append(key)
+            if len(keys) >= chunk_size:
+                cleared += await self.redis_client.unlink(*keys)
+                keys = []
+        own_keys = [self.REGISTRY_KEY, self.SEQ_KEY, self.SESSION_KEY] + ([self.config.stream_key] if self.config.stream_key else [])
+        cleared += await self.redis_client.unlink(*keys, *own_keys)
+        self._registered.clear()
+        self.sequence = 0
+        self.session = None
+        return cleared
+
+    async def retire_instruments(self, instrument_ids: List[str], chunk_size: int = 1000) -> int:
+        """Stop publishing instrument_ids: their keys and registry entries are removed.
+
+        The simulator keeps their state, an instrument that comes back is
+        published again on its next step.
+        """
+        retired = 0
+        for i in range(0, len(instrument_ids), chunk_size):
+            chunk = instrument_ids[i:i + chunk_size]
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                await pipe.unlink(*[f'{self.PRICE_PREFIX}{inst_id}' for inst_id in chunk])
+                await pipe.srem(self.REGISTRY_KEY, *chunk)
+                retired += (await pipe.execute())[0]
+        self._registered.difference_update(instrument_ids)
+        if self.simulator is not None:
+            known = [inst_id for inst_id in instrument_ids if inst_id in self.simulator.index]
+            self.simulator.mark_unpublished(known)
+        return retired
+
+    async def load_board(self, chunk_size: int = 10_000) -> Tuple[List[str], Dict[str, np.ndarray]]:
+        """Every registered instrument and its price fields as arrays, one round trip per chunk"""
+        instrument_ids: List[str] = []
+        columns: Dict[str, list] = {field: [] for field in PRICE_FIELDS}
+        cursor = 0
+        while True:
+            cursor, members = await self.redis_client.sscan(self.REGISTRY_KEY, cursor, count=chunk_size)
+            ids = [m.decode() for m in members]
+            if ids:
+                keys = [f'{self.PRICE_PREFIX}{inst_id}' for inst_id in ids]
+                if self.packed:
+                    records, present = decode_records(await self.redis_client.mget(keys))
+                else:
+                    async with self.redis_client.pipeline(transaction=False) as pipe:
+                        for key in keys:
+                            await pipe.hmget(key, PRICE_FIELDS)
+                        values = await pipe.execute()
+                    present = np.array([v[0] is not None for v in values], dtype=bool)
+                    records = pack_quotes({field: [float(v[i] or 0) for v in values]
+                                           for i, field in enumerate(PRICE_FIELDS)}, 0)
+                instrument_ids.extend(inst_id for inst_id, ok in zip(ids, present) if ok)
+                for field in PRICE_FIELDS:
+                    columns[field].append(records[field][present])
+            if cursor == 0:
+                break
+        return instrument_ids, {field: np.concatenate(chunks) if chunks else np.empty(0)
+                                for field, chunks in columns.items()}
+
+    async def warm_start(self, instrument_ids: Optional[List[str]] = None) -> int:
+        """Resume from the prices already published instead of rebuilding the universe.
+
+        The cycle sequence continues from Redis, or from the snapshot when
+        that is further along (Redis was wiped). With a simulator its state
+        is reloaded from snapshot_path when the file exists (exact continuous
+        prices), otherwise from the board in Redis; either way restricted
+        to instrument_ids when given. A board left by an earlier session is
+        rolled (see roll_session). Returns the number of instruments restored.
+        """
+        if not self.redis_client:
+            await self.connect_redis()
+        stored_sequence = self.sequence = int(await self.redis_client.get(self.SEQ_KEY) or 0)
+        session = await self.redis_client.get(self.SESSION_KEY)
+        self.session = date.fromisoformat(session.decode()) if session else None
+        if self.config.simulator is None and self.simulator is None:
+            return 0
+        if self.simulator is None:
+            self.simulator = MarketSimulator([], config=self.config.simulator)
+
+        path = self.config.snapshot_path
+        if path and os.path.exists(path):
+            state = self.simulator.load(path, instrument_ids)
+            ids = state['instrument_ids'].tolist()
+            self.sequence = max(self.sequence, int(state.get('sequence', 0)))
+            if str(state.get('session', '')):
+                # the simulator state is the snapshot's, so is its session
+                self.session = date.fromisoformat(str(state['session']))
+            # Anything missing from Redis is republished on the next step
+            self._registered = {m.decode() for m in await self.redis_client.smembers(self.REGISTRY_KEY)}
+            self.simulator.mark_unpublished(ids, [i not in self._registered for i in ids])
+            if self.sequence > stored_sequence:
+                # the next cycle's INCR continues from here, the stream seq never goes backwards
+                await self.redis_client.set(self.SEQ_KEY, self.sequence)
+        else:
+            ids, quotes = await self.load_board()
+            if instrument_ids is not None:
+                wanted = set(instrument_ids)
+                keep = np.array([i in wanted for i in ids], dtype=bool)
+                ids = [i for i, k in zip(ids, keep) if k]
+                quotes = {field: values[keep] for field, values in quotes.items()}
+            self.simulator.restore(ids, quotes['last'], quotes['yest'], quotes['spread'])
+            self._registered.update(ids)
+        await self.roll_session()
+        return len(ids)
+
+    async def roll_session(self, today: Optional[date] = None) -> bool:
+        """Start today's session when the state is from an earlier date, returns whether it rolled.
+
+        The last quotes become yest (MarketSimulator.roll_day) and every
+        instrument is republished so the board carries the new close.
+        """
+        today = today or date.today()
+        if self.session == today:
+            return False
+        rolled = self.session is not None and self.session < today and self.simulator is not None
+        if rolled:
+            self.simulator.roll_day()
+            self.simulator.mark_unpublished(self.simulator.instrument_ids)
+        self.session = today
+        await self.redis_client.set(self.SESSION_KEY, today.isoformat())
+        return rolled
+
+    def snapshot(self) -> None:
+        """Write the simulator state and sequence to snapshot_path for the next warm start"""
+        if self.simulator is not None and self.config.snapshot_path:
+            self.simulator.save(self.config.snapshot_path, sequence=self.sequence,
+                                session=self.session.isoformat() if self.session else '')
 
     async def close_redis(self) -> None:
         if self.redis_client:
@@ -54,82 +305,264 @@ class InstrumentPricingService:
             'timestamp': datetime.now().isoformat()
         }
 
-    async def update_instrument_batch(self, instrument_ids: List[str]) -> None:
-        """Update prices for a batch of instruments"""
+    async def _read_lasts(self, price_keys: List[str]) -> List[Optional[float]]:
+        """Current last price per key in one round trip, None where there is none"""
+        if self.packed:
+            started = time.perf_counter_ns()
+            values = await self.redis_client.mget(price_keys)
+            REDIS_SECONDS.record_ns(time.perf_counter_ns() - started)
+            records, present = decode_records(values)
+            return [float(last) if ok else None for last, ok in zip(records['last'], present)]
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for key in price_keys:
+                await pipe.hget(key, 'last')
+            started = time.perf_counter_ns()
+            lasts = await pipe.execute()
+            REDIS_SECONDS.record_ns(time.perf_counter_ns() - started)
+            return [None if last is None else float(last) for last in lasts]
+
+    async def update_instrument_batch(self, instrument_ids: List[str]) -> int:
+        """Update prices for a batch of instruments, returns the number written"""
+        price_keys = [f'{self.PRICE_PREFIX}{inst_id}' for inst_id in instrument_ids]
+
+        # Read every current last price of the batch in one round trip
+        current_lasts = await self._read_lasts(price_keys)
+
+        changed_ids = []
+        quotes = {field: [] for field in PRICE_FIELDS}
+        new_ids = []
+        for inst_id, current_last in zip(instrument_ids, current_lasts):
+            # Get new price data
+            price_data = await self.mock_pricing_service(inst_id)
+
+            # Only update if price has changed or no previous price exists
+            if current_last is None or current_last != price_data['last']:
+                changed_ids.append(inst_id)
+                for field in PRICE_FIELDS:
+                    quotes[field].append(price_data[field])
+            if current_last is None:
+                new_ids.append(inst_id)
+
+        await self._write_prices(changed_ids, quotes, new_ids)
+        return len(changed_ids)
+
+    async def update_simulated_batch(self, idx: np.ndarray) -> int:
+        """Write the current simulator quotes for idx, which the caller knows have moved"""
+        quotes = {field: values.tolist() for field, values in self.simulator.quotes(idx).items()}
+        instrument_ids = [self.simulator.instrument_ids[i] for i in idx]
+        new_ids = [inst_id for inst_id in instrument_ids if inst_id not in self._registered]
         try:
-            price_updates = {}
-            for inst_id in instrument_ids:
-                price_key = f'{self.PRICE_PREFIX}{inst_id}'
-                # Get current last price
-                current_last = await self.redis_client.hget(price_key, 'last')
-                
-                # Get new price data
-                price_data = await self.mock_pricing_service(inst_id)
-                
-                # Only update if price has changed or no previous price exists
-                if current_last is None or float(current_last) != price_data['last']:
-                    price_updates[price_key] = price_data
-
-            # Only execute pipeline if there are updates
-            if price_updates:
-                async with self.redis_client.pipeline() as pipe:
-                    for key, data in price_updates.items():
-                        await pipe.hset(key, mapping=data)
-                    await pipe.execute()
-        except Exception as e:
+            await self._write_prices(instrument_ids, quotes, new_ids)
+        except BaseException:
+            # step already cleared their flags, a failed or timed-out (cancelled) write is retried next cycle
+            self.simulator.mark_unpublished(instrument_ids)
             raise
+        self._registered.update(new_ids)
+        return len(instrument_ids)
+
+    async def _write_prices(self, instrument_ids: List[str], quotes: Dict[str, list], new_ids: List[str]) -> None:
+        """Write per-field quote columns for instrument_ids in one pipeline"""
+        # Only execute pipeline if there are updates
+        if not instrument_ids:
+            return
+        price_keys = [f'{self.PRICE_PREFIX}{inst_id}' for inst_id in instrument_ids]
+        records = pack_quotes(quotes, time.time_ns())
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            if self.packed:
+                await pipe.mset(dict(zip(price_keys, encode_records(records))))
+            else:
+                timestamp = datetime.now().isoformat()
+                for j, key in enumerate(price_keys):
+                    mapping = {field: quotes[field][j] for field in PRICE_FIELDS}
+                    mapping['timestamp'] = timestamp
+                    await pipe.hset(key, mapping=mapping)
+            if new_ids:
+                await pipe.sadd(self.REGISTRY_KEY, *new_ids)
+            if self.config.stream_key:
+                # One entry per batch, consumers read the deltas instead of rescanning the board
+                entry = {**encode_batch(instrument_ids, records), 'seq': self.sequence}
+                if self.config.shard:
+                    entry['shard'] = self.config.shard
+                await pipe.xadd(self.config.stream_key, entry,
+                                maxlen=self.config.stream_maxlen, approximate=True)
+            started = time.perf_counter_ns()
+            await pipe.execute()
+            REDIS_SECONDS.record_ns(time.perf_counter_ns() - started)
+        for listener in self.listeners:
+            listener(instrument_ids, records)
+
+    async def update_all_instrument_prices(self, instrument_ids: List[str]) -> CycleStats:
+        """Concurrently update prices for all instruments in batches.
 
-    async def update_all_instrument_prices(self, instrument_ids: List[str]) -> None:
-        """Concurrently update prices for all instruments in batches"""
+        With a simulator configured every instrument is advanced in one
+        vectorised step and only those whose quote moved are written, with
+        no Redis read; otherwise each batch is compared against Redis.
+        """
         if not self.redis_client:
             await self.connect_redis()
+        self.sequence = await self.redis_client.incr(self.SEQ_KEY)
 
-        # Process in batches
-        for i in range(0, len(instrument_ids), self.config.batch_size):
-            batch = instrument_ids[i:i + self.config.batch_size]
-            await self.update_instrument_batch(batch)
+        size = self.config.batch_size
+        if self.config.simulator is not None or self.simulator is not None:
+            if self.simulator is None:
+                self.simulator = MarketSimulator(instrument_ids, config=self.config.simulator)
+            moved = self.simulator.step(self.simulator.indices(instrument_ids))
+            batches = [moved[i:i + size] for i in range(0, len(moved), size)]
+            update = self.update_simulated_batch
+        else:
+            batches = [instrument_ids[i:i + size] for i in range(0, len(instrument_ids), size)]
+            update = self.update_instrument_batch
+        return await self._run_batches(len(instrument_ids), batches, update)
 
-    async def get_instrument_details(self) -> Dict[str, Dict]:
-        """Retrieve all instrument prices"""
+    async def _run_batches(self, instruments: int, batches: list, update) -> CycleStats:
+        stats = CycleStats(instruments=instruments, batches=len(batches))
+        # Each batch holds one pooled connection at a time, so never run more than the pool
+        limit = min(self.config.max_concurrency or self.config.pool_size, self.config.pool_size)
+        semaphore = asyncio.Semaphore(limit)
+        waiting = len(batches)
+
+        async def run_batch(batch) -> int:
+            nonlocal waiting
+            async with semaphore:
+                waiting -= 1
+                BATCHES_WAITING.record(waiting)
+                started = time.perf_counter_ns()
+                try:
+                    return await asyncio.wait_for(update(batch), self.config.batch_timeout)
+                finally:
+                    BATCH_SECONDS.record_ns(time.perf_counter_ns() - started)
+
+        start_time = time.perf_counter()
+        # Cancelling the cycle cancels every batch still pending or in flight
+        results = await asyncio.gather(*(run_batch(batch) for batch in batches), return_exceptions=True)
+        stats.elapsed = time.perf_counter() - start_time
+
+        for result in results:
+            if isinstance(result, asyncio.TimeoutError):
+                stats.timed_out += 1
+            elif isinstance(result, Exception):
+                stats.failed += 1
+                print(f"Batch failed: {result!r}")
+            else:
+                stats.updated += result
+        UPDATES.inc(stats.updated)
+        SKIPS.inc(instruments - stats.updated)
+        ERRORS.inc(stats.failed)
+        TIMEOUTS.inc(stats.timed_out)
+        return stats
+
+    async def iter_prices(self, chunk_size: int = 1000, use_registry: bool = True) -> AsyncIterator[List[PriceRecord]]:
+        """Stream the price board in chunks of at most roughly chunk_size records.
+
+        Walks the instrument registry with SSCAN (or the keyspace with SCAN) and
+        fetches each chunk's prices in one round trip, so Redis is never blocked
+        for the whole board and only one chunk is held in memory. Like any
+        SCAN, an instrument may be yielded more than once.
+        """
         if not self.redis_client:
             raise RuntimeError("Redis client not connected")
 
-        details = {}
-        price_keys = await self.redis_client.keys(f'{self.PRICE_PREFIX}*')
-        
-        async with self.redis_client.pipeline() as pipe:
+        cursor = 0
+        while True:
+            if use_registry:
+                cursor, members = await self.redis_client.sscan(self.REGISTRY_KEY, cursor, count=chunk_size)
+                instrument_ids = [m.decode() for m in members]
+            else:
+                cursor, keys = await self.redis_client.scan(cursor, match=f'{self.PRICE_PREFIX}*', count=chunk_size)
+                instrument_ids = [k.decode()[len(self.PRICE_PREFIX):] for k in keys]
+
+            if instrument_ids:
+                yield await self.fetch_prices(instrument_ids)
+            if cursor == 0:
+                break
+
+    async def fetch_prices(self, instrument_ids: List[str]) -> List[PriceRecord]:
+        """Prices of instrument_ids in one round trip, unpriced instruments are skipped"""
+        price_keys = [f'{self.PRICE_PREFIX}{inst_id}' for inst_id in instrument_ids]
+        if self.packed:
+            started = time.perf_counter_ns()
+            values = await self.redis_client.mget(price_keys)
+            REDIS_SECONDS.record_ns(time.perf_counter_ns() - started)
+            records, present = decode_records(values)
+            return [PriceRecord.from_packed(inst_id, record)
+                    for inst_id, record, ok in zip(instrument_ids, records, present) if ok]
+        async with self.redis_client.pipeline(transaction=False) as pipe:
             for key in price_keys:
                 await pipe.hgetall(key)
+            started = time.perf_counter_ns()
             results = await pipe.execute()
+            REDIS_SECONDS.record_ns(time.perf_counter_ns() - started)
+        return [PriceRecord.from_hash(inst_id, fields)
+                for inst_id, fields in zip(instrument_ids, results) if fields]
 
-        for key, price_data in zip(price_keys, results):
-            instrument_id = key.decode().replace(self.PRICE_PREFIX, '')
-            details[instrument_id] = {
-                'prices': {k.decode(): float(v.decode()) for k, v in price_data.items()}
-            }
+    async def iter_price_batches(self, chunk_size: int = 1000, use_registry: bool = True) -> AsyncIterator[pa.RecordBatch]:
+        """Same stream as iter_prices as Arrow record batches"""
+        async for records in self.iter_prices(chunk_size, use_registry):
+            yield pa.RecordBatch.from_pylist([vars(r) for r in records], schema=PRICE_SCHEMA)
+
+    async def get_instrument_details(self) -> Dict[str, Dict]:
+        """Retrieve all instrument prices"""
+        details = {}
+        async for records in self.iter_prices():
+            for record in records:
+                prices = vars(record).copy()
+                del prices['instrument_id']
+                details[record.instrument_id] = {'prices': prices}
         return details
 
 async def main() -> None:
-    config = PricingConfig()
-    instrument_ids = [f'INST_{i}' for i in range(1, 100)]
+    # Imported here, both modules build on this one
+    from create_tables import Store
+    from ticksink import TickSink
+    from universe import SYNC_INTERVAL, InstrumentUniverse
+
+    config = PricingConfig(simulator=SimulatorConfig(), snapshot_path='pricing_state.npz')
     pricing_service = InstrumentPricingService(config)
+    store = Store()
+    # Its own ClickHouse client, the writer thread inserts while the universe sync queries
+    sink = TickSink()
+    # Prometheus text on :9108/metrics, METRICS_PORT / METRICS_FILE override
+    REGISTRY.export(default_port=9108)
     
     try:
         await pricing_service.connect_redis()
+        sink.start()
+        pricing_service.listeners.append(sink)
+        universe = InstrumentUniverse(pricing_service, store.client)
+        print(f"Loaded {universe.load()} instruments from ref_instruments up to {universe.watermark}")
+        restored = await pricing_service.warm_start(universe.instrument_ids)
+        print(f"Warm start restored {restored} instruments at sequence {pricing_service.sequence}")
 
+        # Fixed-rate ticks: sleep to the next deadline so the update time does not add drift
+        # (scheduler.TieredScheduler gives per-instrument refresh rates)
+        deadline = time.monotonic()
+        next_sync = deadline + SYNC_INTERVAL
         while True:
-            start_time = time.time()
-            await pricing_service.update_all_instrument_prices(instrument_ids)
-            print(f"Updated prices for {len(instrument_ids)} instruments in {time.time() - start_time:.2f} seconds")
+            if time.monotonic() >= next_sync:
+                print(f"Universe sync: {await universe.sync()}")
+                if await pricing_service.roll_session():
+                    print(f"Rolled into the {pricing_service.session} session")
+                print(f"Tick history: {sink.written} written, {sink.dropped} dropped, {sink.failed} failed")
+                next_sync += SYNC_INTERVAL
+            stats = await pricing_service.update_all_instrument_prices(universe.instrument_ids)
+            print(f"Updated prices for {stats}")
             print('Current time:', datetime.now().isoformat())
-            await asyncio.sleep(config.update_interval)
+            deadline += config.update_interval
+            if deadline < time.monotonic():
+                missed = int((time.monotonic() - deadline) // config.update_interval) + 1
+                print(f"Update overran, skipping {missed} missed ticks")
+                deadline += missed * config.update_interval
+            await asyncio.sleep(deadline - time.monotonic())
 
     except KeyboardInterrupt:
         pass
     except Exception as e:
         raise
     finally:
+        sink.stop()
+        pricing_service.snapshot()
         await pricing_service.close_redis()
+        store.close()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
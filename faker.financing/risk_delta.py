@@ -0,0 +1,120 @@
+import os
+from pathlib import Path
+from datetime import date, datetime
+from typing import Optional, Sequence, Tuple
+
+import polars as pl
+from create_tables import Tables
+
+# Columns that identify a row or a run rather than describe the trade's risk;
+# they change every version and are left out of the fingerprint
+NON_VALUE_COLUMNS = ['id', 'eventId', 'snapId', 'snapVersion', 'calculatedAt', 'isDeleted']
+FINGERPRINT_SEED = 0x5EED
+
+
+def risk_fingerprints(risk: pl.DataFrame) -> pl.DataFrame:
+    """id -> 64-bit hash over the value columns of each risk row"""
+    values = risk.drop(NON_VALUE_COLUMNS, strict=False)
+    return pl.DataFrame({
+        'id': risk['id'],
+        'fingerprint': values.hash_rows(seed=FINGERPRINT_SEED),
+    })
+
+
+class FingerprintCache:
+    """Fingerprints of the last published version of each snapshot, one parquet file per snapId"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path or os.getenv('RISK_FINGERPRINT_DIR', '.risk_fingerprints'))
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, snapId: str) -> Path:
+        return self.path / f"{snapId}.parquet"
+
+    def load(self, snapId: str, snapVersion: int) -> Optional[pl.DataFrame]:
+        """Fingerprints written by snapVersion, or None if the cache holds another version"""
+        file = self._file(snapId)
+        if not file.exists():
+            return None
+        cached = pl.read_parquet(file)
+        if cached.is_empty() or cached['snapVersion'][0] != snapVersion:
+            return None
+        return cached.drop('snapVersion')
+
+    def save(self, snapId: str, snapVersion: int, fingerprints: pl.DataFrame) -> None:
+        file = self._file(snapId)
+        tmp = file.with_suffix('.tmp')
+        fingerprints.with_columns(pl.lit(snapVersion, pl.Int64).alias('snapVersion')).write_parquet(tmp)
+        tmp.replace(file)
+
+
+def delta_risk_frame(risk: pl.DataFrame, previous: Optional[pl.DataFrame]) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """Rows of risk whose values differ from the previous version, plus the new fingerprints.
+
+    With no previous fingerprints every row counts as changed.
+    """
+    fingerprints = risk_fingerprints(risk)
+    if previous is None:
+        return risk, fingerprints
+    changed = fingerprints.join(previous, on=['id', 'fingerprint'], how='anti')
+    return risk.join(changed.select('id'), on='id', how='semi'), fingerprints
+
+
+def removed_ids(previous_ids: Sequence[str], current_ids: Sequence[str]) -> list:
+    """Ids present in the previous version and missing from the current one"""
+    current = set(current_ids)
+    return [i for i in previous_ids if i not in current]
+
+
+def tombstone_frame(ids: Sequence[str], snapId: str, snapVersion: int, asOfDate: date,
+                    calculatedAt: datetime) -> pl.DataFrame:
+    """risk_f rows marking trades removed at snapVersion, the value columns take their defaults"""
+    return pl.DataFrame({
+        'id': pl.Series(list(ids), dtype=pl.Utf8),
+        'snapId': snapId,
+        'snapVersion': pl.Series([snapVersion] * len(ids), dtype=pl.Int64),
+        'asOfDate': asOfDate,
+        'calculatedAt': calculatedAt,
+        'isDeleted': pl.Series([1] * len(ids), dtype=pl.UInt8),
+    })
+
+
+def _latest_rows(columns: str) -> str:
+    return f"""
+    SELECT {columns} FROM (
+        SELECT * FROM {Tables.RISK.value}
+        WHERE snapId = %(snapId)s AND snapVersion <= %(snapVersion)s
+        ORDER BY id, snapVersion DESC
+        LIMIT 1 BY id
+    )
+    WHERE isDeleted = 0
+    """
+
+
+def read_risk_snapshot(client, snapId: str, snapVersion: int) -> pl.DataFrame:
+    """Full snapshot as of snapVersion: the latest row at or below that version for every live trade.
+
+    Delta-published versions only hold changed rows, so the rest are carried
+    forward from earlier versions; trades removed by then end in a tombstone
+    and are left out. risk_f keeps every version in its (snapId, id,
+    snapVersion) key, so any version can be rebuilt.
+    """
+    query = _latest_rows('* EXCEPT (isDeleted)')
+    return pl.from_arrow(client.query_arrow(query, parameters={'snapId': snapId, 'snapVersion': snapVersion}))
+
+
+def read_risk_view(client, snapId: str) -> pl.DataFrame:
+    """Latest version of every live trade of snapId in risk_view, the same trades read_risk_snapshot returns"""
+    query = f"""
+    SELECT * EXCEPT (isDeleted) FROM {Tables.RISKVIEW.value} FINAL
+    WHERE snapId = %(snapId)s AND isDeleted = 0
+    """
+    return pl.from_arrow(client.query_arrow(query, parameters={'snapId': snapId}))
+
+
+def live_ids(client, snapId: str, snapVersion: int) -> list:
+    """Ids of the trades live at snapVersion, for tombstones when no fingerprints are cached"""
+    if snapVersion < 0:
+        return []
+    result = client.query(_latest_rows('id'), parameters={'snapId': snapId, 'snapVersion': snapVersion})
+    return [row[0] for row in result.result_rows]
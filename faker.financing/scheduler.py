@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import polars as pl
+from create_tables import Store
+from marketsim import SimulatorConfig, correlated_simulator, load_instrument_universe
+from pricingservice import InstrumentPricingService, PricingConfig
+from ticksink import TickSink
+
+# Refresh period in seconds per tier
+TIERS = {'fast': 0.1, 'normal': 1.0, 'slow': 60.0}
+# Liquid, highly rated names refresh fastest
+RATING_TIERS = {
+    'AAA': 'fast', 'AA': 'fast',
+    'A': 'normal', 'BBB': 'normal',
+    'BB': 'slow', 'B': 'slow', 'CCC': 'slow',
+}
+DEFAULT_TIER = 'normal'
+# Instruments per heap entry, a tier is split into staggered slots of this size
+SLOT_SIZE = 1000
+
+
+def assign_tiers(universe: pl.DataFrame, by: str = 'rating', mapping: Optional[Dict[str, str]] = None,
+                 default: str = DEFAULT_TIER) -> Dict[str, List[str]]:
+    """Instrument ids per tier from a reference data column (see marketsim.load_instrument_universe)"""
+    mapping = RATING_TIERS if mapping is None and by == 'rating' else (mapping or {})
+    tiers = universe.select(
+        'id', pl.col(by).cast(pl.Utf8).replace_strict(mapping, default=default).alias('tier')
+    )
+    return {tier: ids for tier, ids in tiers.group_by('tier', maintain_order=True).agg('id').iter_rows()}
+
+
+@dataclass
+class TierStats:
+    period: float
+    instruments: int
+    runs: int = 0
+    missed: int = 0        # scheduled refreshes skipped because their slot was already a full period late
+    max_lag: float = 0.0   # worst delay between due time and pricing start, seconds
+
+    def __str__(self) -> str:
+        return (f"{self.instruments} instruments every {self.period:g}s: {self.runs} runs, "
+                f"{self.missed} missed, max lag {self.max_lag * 1000:.1f}ms")
+
+
+class TieredScheduler:
+    """Prices each instrument on its tier's period without drift.
+
+    Every tier is cut into slots whose first deadlines are staggered across
+    the period, and the slots sit in a heap keyed by their next deadline.
+    Deadlines advance by whole periods from the previous deadline, never from
+    when the work finished, so the tick rate stays fixed however long the
+    pricing takes. A slot that falls more than a period behind skips the
+    deadlines it can no longer meet and counts them as missed.
+    """
+
+    def __init__(self, service: InstrumentPricingService, tiers: Dict[str, List[str]],
+                 periods: Optional[Dict[str, float]] = None, slot_size: int = SLOT_SIZE):
+        self.service = service
+        periods = periods or TIERS
+        self.stats = {tier: TierStats(periods[tier], len(ids)) for tier, ids in tiers.items()}
+        self.slots: List[List[str]] = []
+        self._heap = []
+        self._seq = itertools.count()
+        start = time.monotonic()
+        for tier, ids in tiers.items():
+            period = periods[tier]
+            chunks = [ids[i:i + slot_size] for i in range(0, len(ids), slot_size)]
+            for k, chunk in enumerate(chunks):
+                self.slots.append(chunk)
+                due = start + period * k / len(chunks)
+                heapq.heappush(self._heap, (due, next(self._seq), tier, len(self.slots) - 1))
+
+    def _pop_due(self, now: float) -> List[str]:
+        """Instruments of every slot due by now, rescheduling each slot to its next deadline"""
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            due, _, tier, slot = heapq.heappop(self._heap)
+            stats = self.stats[tier]
+            stats.runs += 1
+            stats.max_lag = max(stats.max_lag, now - due)
+            # Skip the deadlines already in the past instead of bursting to catch up
+            behind = int((now - due) // stats.period)
+            stats.missed += behind
+            heapq.heappush(self._heap, (due + (behind + 1) * stats.period, next(self._seq), tier, slot))
+            due_ids.extend(self.slots[slot])
+        return due_ids
+
+    async def run(self, cycles: Optional[int] = None) -> None:
+        """Price due instruments until cancelled, or for a number of wake-ups"""
+        if not self._heap:
+            return
+        for _ in (range(cycles) if cycles is not None else itertools.count()):
+            due_ids = self._pop_due(time.monotonic())
+            if due_ids:
+                stats = await self.service.update_all_instrument_prices(due_ids)
+                if stats.failed or stats.timed_out:
+                    print(f"Scheduled cycle: {stats}")
+            await asyncio.sleep(max(self._heap[0][0] - time.monotonic(), 0))
+
+    def report(self) -> str:
+        return '\n'.join(f"{tier}: {stats}" for tier, stats in self.stats.items())
+
+
+async def main() -> None:
+    store = Store()
+    universe = load_instrument_universe(store.client)
+    store.close()
+
+    config = PricingConfig(simulator=SimulatorConfig())
+    service = InstrumentPricingService(config, simulator=correlated_simulator(universe, config.simulator))
+    await service.connect_redis()
+    sink = TickSink()
+    sink.start()
+    service.listeners.append(sink)
+    scheduler = TieredScheduler(service, assign_tiers(universe))
+    try:
+        while True:
+            await scheduler.run(cycles=100)
+            print(scheduler.report())
+            print(f"Tick history: {sink.written} written, {sink.dropped} dropped, {sink.failed} failed")
+    finally:
+        sink.stop()
+        await service.close_redis()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
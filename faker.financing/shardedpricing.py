@@ -0,0 +1,365 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing as mp
+import os
+import queue
+import time
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from backends import make_client
+from marketsim import SimulatorConfig
+from pricingservice import CycleStats, InstrumentPricingService, PriceRecord, PricingConfig
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hash ring of shard names with virtual nodes.
+
+    Adding or removing a shard only moves the instruments on the arcs it
+    gains or loses, about 1/N of the universe, and every process computes
+    the same owner for an instrument without coordination.
+    """
+
+    def __init__(self, shards: Sequence[str], vnodes: int = 128):
+        self.shards = list(shards)
+        points = sorted((_hash(f'{shard}#{i}'), shard) for shard in self.shards for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    def shard_for(self, instrument_id: str) -> str:
+        i = bisect.bisect(self._hashes, _hash(instrument_id)) % len(self._hashes)
+        return self._owners[i]
+
+    def assign(self, instrument_ids: Sequence[str]) -> Dict[str, List[str]]:
+        assignment: Dict[str, List[str]] = {shard: [] for shard in self.shards}
+        for inst_id in instrument_ids:
+            assignment[self.shard_for(inst_id)].append(inst_id)
+        return assignment
+
+
+@dataclass
+class ShardConfig:
+    shards: int = field(default_factory=lambda: os.cpu_count() or 1)
+    # (host, port) per Redis node, shards are spread over them; None keeps every shard on the pricing config's node
+    redis_nodes: Optional[List[Tuple[str, int]]] = None
+    vnodes: int = 128
+    restart_delay: float = 1.0  # seconds before a dead worker is restarted
+    ack_timeout: float = 30.0  # seconds a shard has to acknowledge a rebalance before it is restarted
+
+
+def shard_names(n: int) -> List[str]:
+    return [f'shard-{i}' for i in range(n)]
+
+
+def shard_node(shard: str, nodes: List[Tuple[str, int]]) -> Tuple[str, int]:
+    """Redis node owning a shard's keys"""
+    return nodes[int(shard.rsplit('-', 1)[1]) % len(nodes)]
+
+
+def _take_over(service: InstrumentPricingService, records: Optional[List[PriceRecord]]) -> None:
+    """Continue instruments moved in from another shard at the quotes their old owner last published"""
+    if not records or service.simulator is None:
+        return
+    ids = [record.instrument_id for record in records]
+    service.simulator.restore(ids, np.array([r.last for r in records]), np.array([r.yest for r in records]),
+                              np.array([r.spread for r in records]))
+    # the old owner may have been on another node, publish them here on the next step
+    service.simulator.mark_unpublished(ids)
+
+
+def _run_shard(shard: str, instrument_ids: List[str], config: PricingConfig,
+               commands: mp.Queue, stats: mp.Queue, moved_in: Optional[List[PriceRecord]] = None) -> None:
+    """Worker process: price one shard on fixed-rate ticks until told to stop.
+
+    Commands are None to stop, or (epoch, instrument ids, price records of
+    the ids moved in) after a rebalance. Commands are applied between
+    cycles and acknowledged with a (shard, pid, epoch, None) report, so once
+    acknowledged the shard writes none of the ids it was told to drop.
+    Cycles are reported as (shard, pid, epoch, cycle stats).
+    """
+    async def run() -> None:
+        ids = instrument_ids
+        epoch = 0
+        service = InstrumentPricingService(config)
+        await service.connect_redis()
+        await service.warm_start(ids)
+        _take_over(service, moved_in)
+        deadline = time.monotonic()
+        try:
+            while True:
+                while True:
+                    try:
+                        command = commands.get_nowait()
+                    except queue.Empty:
+                        break
+                    if command is None:
+                        return
+                    epoch, ids, records = command
+                    _take_over(service, records)
+                    stats.put((shard, os.getpid(), epoch, None))
+                cycle = await service.update_all_instrument_prices(ids)
+                stats.put((shard, os.getpid(), epoch, cycle))
+                deadline = max(deadline + config.update_interval, time.monotonic())
+                await asyncio.sleep(deadline - time.monotonic())
+        finally:
+            service.snapshot()
+            await service.close_redis()
+
+    asyncio.run(run())
+
+
+async def _clear_node(pricing: PricingConfig, shards: List[str]) -> None:
+    """Drop the node's prices and shared keys, and the sequence and session keys of its shards"""
+    service = InstrumentPricingService(pricing)
+    await service.connect_redis(clear=True)
+    for shard in shards:
+        own = InstrumentPricingService(replace(pricing, shard=shard))
+        await service.redis_client.unlink(own.SEQ_KEY, own.SESSION_KEY)
+    await service.close_redis()
+
+
+async def _read_node(pricing: PricingConfig, instrument_ids: List[str]) -> List[PriceRecord]:
+    service = InstrumentPricingService(pricing)
+    await service.connect_redis()
+    try:
+        return await service.fetch_prices(instrument_ids)
+    finally:
+        await service.close_redis()
+
+
+@dataclass
+class ShardState:
+    process: mp.Process
+    commands: mp.Queue
+    instrument_ids: List[str]
+    restarts: int = 0
+    last_cycle: Optional[CycleStats] = None
+
+
+class ShardSupervisor:
+    """Starts one pricing process per shard, restarts dead ones and rebalances on resize"""
+
+    def __init__(self, instrument_ids: Sequence[str], config: Optional[ShardConfig] = None,
+                 pricing: Optional[PricingConfig] = None):
+        self.config = config or ShardConfig()
+        self.pricing = pricing or PricingConfig()
+        self.instrument_ids = list(instrument_ids)
+        self.nodes = self.config.redis_nodes or [(self.pricing.redis_host, self.pricing.redis_port)]
+        # spawn gives each worker a fresh interpreter, no forked event loop or sockets
+        self._ctx = mp.get_context('spawn')
+        self._stats = self._ctx.Queue()
+        self.ring = HashRing(shard_names(self.config.shards), self.config.vnodes)
+        self.workers: Dict[str, ShardState] = {}
+        # incremented per rebalance, shards acknowledge the epoch of the last command they applied
+        self._epoch = 0
+
+    def _pricing_for(self, shard: str) -> PricingConfig:
+        host, port = shard_node(shard, self.nodes)
+        # the connection pool is per process, split the configured size between this node's shards
+        per_node = max(1, -(-len(self.ring.shards) // len(self.nodes)))
+        snapshot = self.pricing.snapshot_path
+        return replace(self.pricing, redis_host=host, redis_port=port, shard=shard,
+                       pool_size=max(1, self.pricing.pool_size // per_node),
+                       snapshot_path=f'{os.path.splitext(snapshot)[0]}.{shard}.npz' if snapshot else None)
+
+    def _spawn(self, shard: str, instrument_ids: List[str], restarts: int = 0,
+               moved_in: Optional[List[PriceRecord]] = None) -> None:
+        commands = self._ctx.Queue()
+        process = self._ctx.Process(target=_run_shard, name=shard, daemon=True,
+                                    args=(shard, instrument_ids, self._pricing_for(shard), commands, self._stats,
+                                          moved_in))
+        process.start()
+        self.workers[shard] = ShardState(process, commands, instrument_ids, restarts)
+
+    def start(self, clear: bool = False) -> None:
+        """Start every shard, warm from the prices already on each node unless clear"""
+        if clear:
+            for host, port in self.nodes:
+                shards = [shard for shard in self.ring.shards if shard_node(shard, self.nodes) == (host, port)]
+                asyncio.run(_clear_node(replace(self.pricing, redis_host=host, redis_port=port), shards))
+        for shard, ids in self.ring.assign(self.instrument_ids).items():
+            self._spawn(shard, ids)
+        print(f"Started {len(self.workers)} shards over {len(self.nodes)} Redis nodes")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        for state in self.workers.values():
+            state.commands.put(None)
+        for state in self.workers.values():
+            state.process.join(timeout)
+            if state.process.is_alive():
+                state.process.terminate()
+        self.workers.clear()
+
+    def check(self) -> None:
+        """Restart any worker that died, with the same instruments"""
+        for shard, state in list(self.workers.items()):
+            if not state.process.is_alive():
+                print(f"{shard} (pid {state.process.pid}) exited with {state.process.exitcode}, restarting")
+                time.sleep(self.config.restart_delay)
+                self._spawn(shard, state.instrument_ids, state.restarts + 1)
+
+    def _command(self, shard: str, instrument_ids: List[str],
+                 moved_in: Optional[List[PriceRecord]] = None) -> None:
+        state = self.workers[shard]
+        state.commands.put((self._epoch, instrument_ids, moved_in))
+        state.instrument_ids = instrument_ids
+
+    def _await_acks(self, shards: List[str], timeout: float) -> List[str]:
+        """Wait for shards to report the current epoch, returns those that did not within timeout"""
+        waiting = set(shards)
+        deadline = time.monotonic() + timeout
+        while waiting:
+            try:
+                shard, _, epoch, cycle = self._stats.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            self._note(shard, cycle)
+            if epoch >= self._epoch:
+                waiting.discard(shard)
+        return sorted(waiting)
+
+    def rebalance(self, shards: int) -> int:
+        """Resize to a number of shards, returns how many instruments changed owner.
+
+        Moved instruments are first taken from their old owners: removed
+        shards stop and surviving ones acknowledge that they no longer price
+        them. Only then are their last quotes read from the old node, handed
+        to the new owners and dropped from nodes that no longer own them.
+        """
+        old_owner = {inst_id: shard for shard, state in self.workers.items() for inst_id in state.instrument_ids}
+        self.ring = HashRing(shard_names(shards), self.config.vnodes)
+        assignment = self.ring.assign(self.instrument_ids)
+        moved = [(inst_id, old, self.ring.shard_for(inst_id)) for inst_id, old in old_owner.items()
+                 if old != self.ring.shard_for(inst_id)]
+        self._epoch += 1
+
+        removed = [self.workers.pop(shard) for shard in list(self.workers) if shard not in assignment]
+        for state in removed:
+            state.commands.put(None)
+        survivors = list(self.workers)
+        for shard in survivors:
+            self._command(shard, [inst_id for inst_id in self.workers[shard].instrument_ids
+                                  if self.ring.shard_for(inst_id) == shard])
+        for state in removed:
+            state.process.join(self.config.ack_timeout)
+            if state.process.is_alive():
+                state.process.terminate()
+                state.process.join()
+        for shard in self._await_acks(survivors, self.config.ack_timeout):
+            # a shard that cannot confirm may still write moved ids, it is restarted below with its new set
+            print(f"{shard} did not acknowledge rebalance {self._epoch}, restarting it")
+            self.workers[shard].process.terminate()
+            self.workers[shard].process.join()
+
+        moved_in = self._read_moved(moved)
+        for shard, ids in assignment.items():
+            state = self.workers.get(shard)
+            if state is not None and state.process.is_alive():
+                self._command(shard, ids, moved_in.get(shard))
+            else:
+                self._spawn(shard, ids, state.restarts + 1 if state else 0, moved_in=moved_in.get(shard))
+        self._drop_moved_keys(moved)
+        print(f"Rebalanced to {shards} shards, {len(moved)} of {len(self.instrument_ids)} instruments moved")
+        return len(moved)
+
+    def _read_moved(self, moved: List[Tuple[str, str, str]]) -> Dict[str, List[PriceRecord]]:
+        """Prices of moved instruments as last published on their old node, by new owner"""
+        by_node: Dict[Tuple[str, int], List[str]] = {}
+        new_owner = {}
+        for inst_id, old, new in moved:
+            by_node.setdefault(shard_node(old, self.nodes), []).append(inst_id)
+            new_owner[inst_id] = new
+        moved_in: Dict[str, List[PriceRecord]] = {}
+        for (host, port), ids in by_node.items():
+            for record in asyncio.run(_read_node(replace(self.pricing, redis_host=host, redis_port=port), ids)):
+                moved_in.setdefault(new_owner[record.instrument_id], []).append(record)
+        return moved_in
+
+    def _drop_moved_keys(self, moved: List[Tuple[str, str, str]]) -> None:
+        """Delete moved instruments from nodes that no longer own them, so readers never see stale prices"""
+        layout = InstrumentPricingService(self.pricing)
+        stale: Dict[Tuple[str, int], List[str]] = {}
+        for inst_id, old, new in moved:
+            old_node = shard_node(old, self.nodes)
+            if old_node != shard_node(new, self.nodes):
+                stale.setdefault(old_node, []).append(inst_id)
+        for (host, port), ids in stale.items():
+            client = make_client(self.pricing.backend, host, port)
+            with client.pipeline(transaction=False) as pipe:
+                pipe.unlink(*[f'{layout.PRICE_PREFIX}{inst_id}' for inst_id in ids])
+                pipe.srem(layout.REGISTRY_KEY, *ids)
+                pipe.execute()
+            client.close()
+
+    def _note(self, shard: str, cycle: Optional[CycleStats]) -> None:
+        if cycle is not None and shard in self.workers:
+            self.workers[shard].last_cycle = cycle
+
+    def collect(self) -> Dict[str, CycleStats]:
+        """Latest cycle per shard reported since the last call"""
+        while True:
+            try:
+                shard, _, _, cycle = self._stats.get_nowait()
+            except queue.Empty:
+                break
+            self._note(shard, cycle)
+        return {shard: state.last_cycle for shard, state in self.workers.items() if state.last_cycle}
+
+    def throughput(self) -> float:
+        """Aggregate instruments priced per second over the latest cycle of every shard"""
+        return sum(cycle.throughput for cycle in self.collect().values())
+
+
+class ShardedPriceReader:
+    """Reads prices from whichever Redis node owns each instrument's shard"""
+
+    def __init__(self, ring: HashRing, nodes: List[Tuple[str, int]], pricing: Optional[PricingConfig] = None):
+        pricing = pricing or PricingConfig()
+        self.ring = ring
+        self.services = {node: InstrumentPricingService(replace(pricing, redis_host=node[0], redis_port=node[1]))
+                         for node in dict.fromkeys(nodes)}
+        self.nodes = nodes
+
+    async def connect(self) -> None:
+        for service in self.services.values():
+            await service.connect_redis()
+
+    async def close(self) -> None:
+        for service in self.services.values():
+            await service.close_redis()
+
+    async def fetch_prices(self, instrument_ids: List[str]) -> List[PriceRecord]:
+        """One round trip per node, in parallel"""
+        by_node: Dict[Tuple[str, int], List[str]] = {}
+        for inst_id in instrument_ids:
+            by_node.setdefault(shard_node(self.ring.shard_for(inst_id), self.nodes), []).append(inst_id)
+        results = await asyncio.gather(*(self.services[node].fetch_prices(ids) for node, ids in by_node.items()))
+        return [record for records in results for record in records]
+
+
+def main() -> None:
+    instrument_ids = [f'INST_{i}' for i in range(100_000)]
+    # e.g. redis_nodes=[('localhost', 6379), ('localhost', 6380)] with two local redis-server instances
+    supervisor = ShardSupervisor(instrument_ids, ShardConfig(),
+                                 PricingConfig(batch_size=1000, simulator=SimulatorConfig()))
+    supervisor.start()
+    try:
+        while True:
+            time.sleep(5)
+            supervisor.check()
+            cycles = supervisor.collect()
+            print(f"{len(cycles)} shards reporting, {sum(c.throughput for c in cycles.values()):,.0f} instruments/s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
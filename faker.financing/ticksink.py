@@ -0,0 +1,110 @@
+import queue
+import threading
+import time
+from typing import List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+from create_tables import Store, Tables
+from pricecodec import PRICE_FIELDS
+
+
+class TickSink:
+    """Buffers every written price and bulk-inserts the history into md_prices.
+
+    Registered as a pricing service listener it is called with each written
+    batch's ids and packed records; the call only appends to an in-memory
+    buffer. The buffer is sealed once it holds max_rows rows or is
+    max_interval seconds old, and a background thread inserts sealed
+    buffers as Arrow. If ClickHouse falls max_pending buffers behind the
+    oldest buffer is dropped and counted, so the pricing loop never waits.
+    """
+
+    def __init__(self, max_rows: int = 100_000, max_interval: float = 1.0, max_pending: int = 32,
+                 store: Optional[Store] = None):
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self.store = store
+        self._owns_store = store is None
+        self._ids: List[Sequence[str]] = []
+        self._records: List[np.ndarray] = []
+        self._rows = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self._sealed: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        if self.store is None:
+            self.store = Store()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='tick-sink', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Insert whatever is buffered and stop the writer thread"""
+        self._seal()
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._owns_store and self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __call__(self, instrument_ids: Sequence[str], records: np.ndarray) -> None:
+        with self._lock:
+            if not self._rows:
+                self._opened_at = time.monotonic()
+            self._ids.append(instrument_ids)
+            self._records.append(records)
+            self._rows += len(records)
+            full = self._rows >= self.max_rows
+        if full:
+            self._seal()
+
+    def _seal(self) -> None:
+        with self._lock:
+            if not self._rows:
+                return
+            batch = (self._ids, self._records, self._rows)
+            self._ids, self._records, self._rows = [], [], 0
+        while True:
+            try:
+                self._sealed.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    self.dropped += self._sealed.get_nowait()[2]
+                except queue.Empty:
+                    pass
+
+    def _run(self) -> None:
+        while self._running or not self._sealed.empty():
+            try:
+                ids, records, rows = self._sealed.get(timeout=self.max_interval / 4)
+            except queue.Empty:
+                with self._lock:
+                    stale = self._rows and time.monotonic() - self._opened_at >= self.max_interval
+                if stale:
+                    self._seal()
+                continue
+            try:
+                self.store.client.insert_arrow(Tables.PRICES.value, self.to_arrow(ids, records))
+                self.written += rows
+            except Exception as e:
+                self.failed += rows
+                print(f"Tick sink insert of {rows} rows failed: {e}")
+
+    @staticmethod
+    def to_arrow(ids: List[Sequence[str]], records: List[np.ndarray]) -> pa.Table:
+        packed = np.concatenate(records)
+        return pa.table({
+            'instrumentId': pa.array([inst_id for batch in ids for inst_id in batch], pa.string()),
+            'ts': pa.array(packed['ts'], pa.timestamp('ns')),
+            **{field: pa.array(packed[field]) for field in PRICE_FIELDS},
+        })
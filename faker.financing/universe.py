@@ -0,0 +1,157 @@
+import asyncio
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+import polars as pl
+from marketsim import MarketSimulator, correlated_simulator, load_instrument_universe
+from pricingservice import InstrumentPricingService
+
+# Seconds between incremental syncs of a running service
+SYNC_INTERVAL = 60.0
+# Seed price when a row has neither a price nor a usable coupon and yield, in percent of par
+DEFAULT_PRICE = 100.0
+
+
+def seed_prices(universe: pl.DataFrame, today: Optional[date] = None) -> np.ndarray:
+    """Starting price per row: price, or the annual-coupon bond price at yieldToMaturity, per 100 of face"""
+    today = today or date.today()
+    days = universe.select((pl.col('maturityDate').cast(pl.Date) - pl.lit(today)).dt.total_days().fill_null(0))
+    years = np.maximum(days.to_series().to_numpy() / 365.25, 0.0)
+    coupon = universe['coupon'].fill_null(0.0).to_numpy()
+    ytm = universe['yieldToMaturity'].fill_null(0.0).to_numpy() / 100
+    with np.errstate(divide='ignore', invalid='ignore'):
+        discount = (1 + ytm) ** -years
+        annuity = np.where(ytm > 0, (1 - discount) / ytm, years)
+    from_yield = coupon * annuity + 100 * discount
+    price = universe['price'].fill_null(0.0).to_numpy()
+    seeded = np.where(price > 0, price, from_yield)
+    return np.where(np.isfinite(seeded) & (seeded > 0), seeded, DEFAULT_PRICE)
+
+
+@dataclass
+class UniverseChange:
+    added: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+    retired: List[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.updated or self.retired)
+
+    def __str__(self) -> str:
+        return f"{len(self.added)} added, {len(self.updated)} updated, {len(self.retired)} retired"
+
+
+class InstrumentUniverse:
+    """The priced instruments, loaded from ref_instruments and kept in sync through updatedAt.
+
+    load reads the table once and seeds the service's simulator; sync then
+    only reads rows updated since the last watermark. New ids are added to
+    the simulator, changed ones whose reference price moved are repriced
+    there (MarketSimulator.reprice, under either model), and matured ones are
+    retired from the board. Rows are versioned rather
+    than deleted, so maturity is what takes an instrument out.
+    """
+
+    def __init__(self, service: InstrumentPricingService, client):
+        self.service = service
+        self.client = client
+        self.watermark: Optional[datetime] = None
+        # ids already applied at the watermark, the next sync re-reads that second and skips them
+        self._seen_at_watermark: set = set()
+        self.instrument_ids: List[str] = []
+        self.maturity: Dict[str, date] = {}
+        # seed price of each instrument's latest row, an update reprices only when it changes
+        self.reference: Dict[str, float] = {}
+        self._checked_on: Optional[date] = None
+
+    def __len__(self) -> int:
+        return len(self.instrument_ids)
+
+    def _advance(self, rows: pl.DataFrame) -> pl.DataFrame:
+        """rows not applied yet, moving the watermark to the newest of them"""
+        if self.watermark is not None:
+            rows = rows.filter((pl.col('updatedAt') > self.watermark)
+                               | ~pl.col('id').is_in(list(self._seen_at_watermark)))
+        if len(rows):
+            latest = rows['updatedAt'].max()
+            at_latest = set(rows.filter(pl.col('updatedAt') == latest)['id'].to_list())
+            if latest == self.watermark:
+                self._seen_at_watermark |= at_latest
+            else:
+                self.watermark, self._seen_at_watermark = latest, at_latest
+        return rows
+
+    def _live(self, rows: pl.DataFrame, today: date) -> pl.DataFrame:
+        return rows.filter(pl.col('maturityDate').is_null() | (pl.col('maturityDate').cast(pl.Date) >= today))
+
+    def load(self) -> int:
+        """Read the whole table and seed the simulator, returns the number of live instruments"""
+        today = date.today()
+        rows = self._advance(load_instrument_universe(self.client))
+        live = self._live(rows, today)
+        config = self.service.config.simulator
+        prices = seed_prices(live, today)
+        if self.service.simulator is None:
+            self.service.simulator = correlated_simulator(live.with_columns(price=prices), config)
+        else:
+            self._add(live, today)
+        self.reference.update(zip(live['id'].to_list(), prices.tolist()))
+        self.instrument_ids = live['id'].to_list()
+        self.maturity = dict(zip(live['id'].to_list(), live['maturityDate'].cast(pl.Date).to_list()))
+        self._checked_on = today
+        return len(self.instrument_ids)
+
+    def _add(self, rows: pl.DataFrame, today: date) -> None:
+        simulator: MarketSimulator = self.service.simulator
+        new = rows.filter(~pl.col('id').is_in(list(simulator.index)))
+        if len(new):
+            prices = seed_prices(new, today)
+            simulator.add_instruments(new['id'].to_list(), prices, new['sector'].to_list(),
+                                      new['region'].to_list(), new['currency'].to_list())
+            self.reference.update(zip(new['id'].to_list(), prices.tolist()))
+
+    async def sync(self) -> UniverseChange:
+        """Apply the rows updated since the watermark and retire what has matured since the last check"""
+        if self.watermark is None:
+            self.load()
+            return UniverseChange(added=list(self.instrument_ids))
+        today = date.today()
+        # Off the event loop, pricing cycles keep running while ClickHouse answers
+        rows = self._advance(await asyncio.to_thread(load_instrument_universe, self.client, self.watermark))
+        change = UniverseChange()
+        active = set(self.instrument_ids)
+
+        live = self._live(rows, today)
+        live_ids = set(live['id'].to_list())
+        change.added = [inst_id for inst_id in live['id'].to_list() if inst_id not in active]
+        change.updated = [inst_id for inst_id in live['id'].to_list() if inst_id in active]
+        change.retired = [inst_id for inst_id in rows['id'].to_list() if inst_id in active and inst_id not in live_ids]
+        if self._checked_on != today:
+            change.retired.extend(inst_id for inst_id, matures in self.maturity.items()
+                                  if matures is not None and matures < today and inst_id not in live_ids)
+            self._checked_on = today
+        change.retired = list(dict.fromkeys(change.retired))
+
+        if change.added:
+            self._add(live.filter(pl.col('id').is_in(change.added)), today)
+        if change.updated:
+            updated = live.filter(pl.col('id').is_in(change.updated))
+            prices = seed_prices(updated, today)
+            repriced = [(inst_id, price) for inst_id, price in zip(updated['id'].to_list(), prices.tolist())
+                        if self.reference.get(inst_id) != price]
+            if repriced:
+                self.service.simulator.reprice([inst_id for inst_id, _ in repriced], [price for _, price in repriced])
+                self.reference.update(repriced)
+        if change.retired:
+            await self.service.retire_instruments(change.retired)
+
+        self.maturity.update(zip(live['id'].to_list(), live['maturityDate'].cast(pl.Date).to_list()))
+        for inst_id in change.retired:
+            self.maturity.pop(inst_id, None)
+            self.reference.pop(inst_id, None)
+        if change.added or change.retired:
+            retired = set(change.retired)
+            self.instrument_ids = [inst_id for inst_id in self.instrument_ids if inst_id not in retired] + change.added
+        return change